@@ -0,0 +1,9 @@
+%:define ACM_BEGIN
+%:include <vector>
+int a<:3:> = <% 1, 2, 3 %>;
+%:define STR(x) %:x
+%:define CAT(x, y) x %:%: y
+std::vector<::std::size_t> v;  // "<::" is "<" "::"
+int b = a<:0:> <: 0 ? 1 : 2;
+bool c = a <::> 0;
+%:define ACM_END
@@ -0,0 +1,11 @@
+#define ACM_BEGIN
+#define MAX(a, b) \
+    ((a) > (b) ? \
+     (a) : (b))
+// a comment continued \
+   on the next line
+const char *s = "a string \
+continued";
+int long_na\
+me = MAX(1, 2);
+#define ACM_END
@@ -0,0 +1,20 @@
+// Line splices inside tokens, before tokens and as whitespace
+#define ACM_BEGIN
+in\
+t x = 12\
+34 + 0x1p\
+-3;
+int y = x\
++ 1;
+unsigned lo\
+ng z = 1\
+0'\
+000;
+int a = 1 \
++ 2 \
+  + 3;
+int b = a\
+\
+- 1;
+#define ACM_END
+int c;\
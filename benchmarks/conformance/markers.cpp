@@ -0,0 +1,16 @@
+/**
+ * title: markers
+ * category: Conformance
+ */
+// #define ACM_BEGIN inside a line comment
+/* #define ACM_END
+   inside a block comment */
+const char *s = "#define ACM_BEGIN";
+const char c = '#';
+  #  define ACM_BEGIN
+int inside = 1;  /* comment */ // comment
+#if 0
+int disabled = '\'';
+#endif
+#define ACM_END
+int outside = 2;
@@ -0,0 +1,12 @@
+// Raw string literals: delimiters, quotes and parentheses inside,
+// and markers that must not be seen as #define lines.
+#define ACM_BEGIN
+const char *a = R"(plain)";
+const char *b = R"x(contains )" and "quotes")x";
+const char *c = u8R"--(
+#define ACM_END
+// not a comment /* nor this */
+)--";
+const wchar_t *d = LR"(wide)";
+const char *e = R"()" "" R"abc()abc";
+#define ACM_END
@@ -0,0 +1,13 @@
+#define ACM_BEGIN
+template <typename T, int N = (8 >> 1)>
+struct Array {
+    T data[N];
+};
+template <typename T> struct Box { T value; };
+Box<Box<Box<int>>> x;
+Array<Box<long long>, (16 >> 2)> y;
+int z = 1 >> 1, w = z >>= 1;
+auto f = [](Box<Box<int>> *p) -> int { return p->value.value; };
+unsigned long long big = 0xFFFF'FFFFull + 1'000'000 + 1e-5 + .5e+3 + 0x1p-3;
+char32_t u = U'\U0001F600';
+#define ACM_END
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Checks that the built-in Python lexer renders every C++ source of a
+# corpus exactly like libclang does, and reports the time of both.
+# Exits with status 1 if any file differs. The default corpus,
+# benchmarks/conformance, covers raw strings, digraphs, line continuations,
+# nested template ">>" and block markers inside comments and strings.
+# Directories without "preferences.py" use default_preferences.py.
+#
+# Usage: benchmarks/highlighter_conformance.py [DIRECTORY]
+
+from __future__ import print_function
+
+import os
+import sys
+import difflib
+import argparse
+import importlib
+
+from timeit import default_timer as timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conformance')
+sys.path.insert(0, ROOT)
+import docmeld
+
+def render(highlighter, path, content):
+    docmeld.highlighter = highlighter
+    start = timer()
+    result = docmeld.render_cxx(path, os.path.dirname(path), content)
+    return result, timer() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the output of the libclang and the Python highlighter.')
+    parser.add_argument('DIRECTORY', nargs='?', default=CORPUS, help='root directory of documents (default: benchmarks/conformance).')
+    args = parser.parse_args()
+
+    os.chdir(args.DIRECTORY)
+    sys.path.append(os.getcwd())
+    if os.path.isfile(docmeld.PREFERENCE_MODULE + '.py'):
+        docmeld.config = importlib.import_module(docmeld.PREFERENCE_MODULE)
+    else:
+        docmeld.config = importlib.import_module('default_preferences')
+    reference = docmeld.LibclangHighlighter()
+    candidate = docmeld.PythonHighlighter()
+    docmeld.highlighter = reference
+    docmeld.initialize_parsers()
+    reference.initialize()
+    candidate.initialize()
+
+    paths = []
+    for dirpath, dnames, fnames in os.walk('.'):
+        dnames[:] = [x for x in dnames if not x.startswith('.')]
+        for name in sorted(fnames):
+            if os.path.splitext(name)[1] in docmeld.config.FILE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(dirpath, name)))
+
+    print('%-48s %8s %13s %13s' % ('file', 'result', 'libclang (ms)', 'python (ms)'))
+    failed = 0
+    total_reference = total_candidate = 0.0
+    for path in sorted(paths):
+        with open(path, 'r') as reader:
+            content = reader.read()
+        expected, elapsed_reference = render(reference, path, content)
+        actual, elapsed_candidate = render(candidate, path, content)
+        total_reference += elapsed_reference
+        total_candidate += elapsed_candidate
+        print('%-48s %8s %13.2f %13.2f' % (
+            path[-48:], 'ok' if actual == expected else 'MISMATCH',
+            elapsed_reference * 1000, elapsed_candidate * 1000))
+        if actual != expected:
+            failed += 1
+            for name, x, y in zip(('code', 'meta', 'slices'), expected, actual):
+                if x == y:
+                    continue
+                if name == 'code':
+                    diff = difflib.unified_diff(x.split('\n'), y.split('\n'), 'libclang', 'python', lineterm='', n=0)
+                    print('\n'.join(list(diff)[:20]))
+                else:
+                    print('  %s: %r != %r' % (name, x, y))
+    print('%d/%d files match. Total: libclang %.2f ms, python %.2f ms.' % (
+        len(paths) - failed, len(paths), total_reference * 1000, total_candidate * 1000))
+    exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Size of the generated page with and without "--compact", raw and
+# gzip-compressed (as served by most web servers).
+#
+# Usage: benchmarks/output_size.py DIRECTORY [docmeld.py options]
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+DOCMELD = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'docmeld.py')
+
+def build(directory, output, options):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, DOCMELD, directory, '-q', '-o', output] + options, stdout=devnull)
+    with open(output, 'rb') as reader:
+        data = reader.read()
+    compressed = output + '.gz'
+    with gzip.open(compressed, 'wb') as writer:
+        writer.write(data)
+    return len(data), os.path.getsize(compressed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the output size of normal and compact mode.')
+    parser.add_argument('DIRECTORY', help='root directory of documents (with "preferences.py").')
+    parser.add_argument('OPTIONS', nargs=argparse.REMAINDER, help='extra options passed to docmeld.py.')
+    args = parser.parse_args()
+
+    temporary = tempfile.mkdtemp(prefix='docmeld-size-')
+    try:
+        normal = build(args.DIRECTORY, os.path.join(temporary, 'normal.html'), args.OPTIONS)
+        compact = build(args.DIRECTORY, os.path.join(temporary, 'compact.html'), args.OPTIONS + ['--compact'])
+    finally:
+        shutil.rmtree(temporary)
+
+    print('%-8s %12s %12s' % ('', 'HTML (KiB)', 'gzip (KiB)'))
+    print('%-8s %12.1f %12.1f' % ('normal', normal[0] / 1024.0, normal[1] / 1024.0))
+    print('%-8s %12.1f %12.1f' % ('compact', compact[0] / 1024.0, compact[1] / 1024.0))
+    print('%-8s %11.1f%% %11.1f%%' % ('saved',
+        100.0 * (normal[0] - compact[0]) / normal[0], 100.0 * (normal[1] - compact[1]) / normal[1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Per-file parse time of the full libclang parse against the fast
+# (single-file, lexer-only) parse used by "docmeld.py --fast".
+#
+# Usage: benchmarks/parse_cxx.py [-r ROUNDS] DIRECTORY
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import importlib
+
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import docmeld
+
+def measure(path, fast, rounds):
+    with open(path, 'r') as reader:
+        content = reader.read()
+    best = None
+    for _ in xrange(rounds):
+        start = timer()
+        # Everything parse_cxx asks libclang for
+        tu = docmeld.parse_translation_unit(path, fast=fast)
+        docmeld.tokenize(tu, path, content)
+        list(tu.cursor.get_children())
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full and fast parse time of each C++ source.')
+    parser.add_argument('DIRECTORY', help='root directory of documents (with "preferences.py").')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='rounds per file, the best is reported (default: 3).')
+    args = parser.parse_args()
+
+    os.chdir(args.DIRECTORY)
+    sys.path.append(os.getcwd())
+    docmeld.config = importlib.import_module(docmeld.PREFERENCE_MODULE)
+    docmeld.highlighter = docmeld.LibclangHighlighter()
+    docmeld.initialize_parsers()
+    docmeld.highlighter.initialize()
+
+    paths = []
+    for dirpath, dnames, fnames in os.walk('.'):
+        dnames[:] = [x for x in dnames if not x.startswith('.')]
+        for name in sorted(fnames):
+            if os.path.splitext(name)[1] in docmeld.config.FILE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(dirpath, name)))
+
+    print('%-48s %10s %10s %8s' % ('file', 'full (ms)', 'fast (ms)', 'speedup'))
+    total_full = total_fast = 0.0
+    for path in sorted(paths):
+        full = measure(path, False, args.rounds)
+        fast = measure(path, True, args.rounds)
+        total_full += full
+        total_fast += fast
+        print('%-48s %10.2f %10.2f %7.1fx' % (path[-48:], full * 1000, fast * 1000, full / fast))
+    if paths:
+        print('%-48s %10.2f %10.2f %7.1fx' % (
+            'total (%s files)' % len(paths), total_full * 1000, total_fast * 1000, total_full / total_fast))
+
+if __name__ == '__main__':
+    main()
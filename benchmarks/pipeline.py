@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# End-to-end build time of docmeld.main() on a generated template
+# repository (default preferences.py layout): a cold build, a build with a
+# warm cache, a build after one source changed, a build after a description
+# was added next to an existing source and a build with nothing changed.
+# Each build runs in a forked process, as in the build server. The output of
+# the incremental scenarios in CHECKED must equal a build without the cache,
+# or the script exits with 2. Results are written as JSON; with a baseline,
+# the script exits with 1 if a scenario got slower than the threshold allows.
+#
+# Usage: benchmarks/pipeline.py [-n FILES] [-r ROUNDS] [-o RESULTS] [--baseline RESULTS] [-- docmeld.py options]
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+
+from timeit import default_timer as timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+import docmeld
+
+SCENARIOS = ['cold', 'warm', 'one-file-changed', 'description-added', 'no-change']
+CHECKED = ['description-added']  # compared with a build without the cache
+OUTPUT = 'output.html'
+REFERENCE_FOLDER = '.reference'  # hidden, so not scanned; same basename as OUTPUT
+
+CXX_BLOCK = u'''
+// {name}: 第 {index} 段
+template <typename T>
+T {name}_{index}(const vector<T> &a, int l, int r) {{
+    T result = T();  /* 区间 [l, r) */
+    for (int i = l; i < r; i++) {{
+        if (a[i] > result) result = a[i] * {index} + 0x{index:x};
+        else result += a[i] % 998244353;
+    }}
+    printf("%d\\n", (int) result);
+    return result;
+}}
+'''
+
+MARKDOWN = u'''# {title}
+
+Runs in $O(n \\log n)$ time and $O(n)$ memory, where $n$ is the size of the input.
+
+$$
+f(x) = \\sum_{{i = 1}}^{{n}} a_i x^i \\pmod{{998244353}}
+$$
+
+| Operation | Time | Memory |
+| --------- | ---- | ------ |
+| build | $O(n)$ | $O(n)$ |
+| query | $O(\\log n)$ | $O(1)$ |
+
+* `{name}_0(a, l, r)`: see the source below.
+* Tested on **{count}** problems.
+'''
+
+STYLE = u'.line .number { color: #999 } .keyword { color: #00f } .comment { color: #080 }\n'
+
+def generate(root, args):
+    rng = random.Random(args.seed)
+    shutil.copyfile(os.path.join(ROOT, 'default_preferences.py'), os.path.join(root, 'preferences.py'))
+    with open(os.path.join(root, 'style.css'), 'w') as writer:
+        writer.write(STYLE.encode('utf-8'))
+    sources = []
+    for i in xrange(args.files):
+        category = i % args.categories
+        folder = os.path.join(root, 'category-%s' % category)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        name = 'algorithm%s' % i
+        title = 'algorithm-%s' % i
+        blocks = []
+        for j in xrange(max(1, args.lines // 12)):
+            blocks.append(CXX_BLOCK.format(name=name, index=j))
+        # ACM_BEGIN/ACM_END around evenly spread blocks
+        step = max(1, len(blocks) // max(1, args.slices))
+        body = []
+        for j in xrange(len(blocks)):
+            sliced = j // step < args.slices and j % step == 0
+            if sliced:
+                body.append(u'#define ACM_BEGIN\n')
+            body.append(blocks[j])
+            if sliced:
+                body.append(u'#define ACM_END\n')
+        header = u'/**\n * title: %s\n * category: Category %s\n * rank: %s\n */\n' % (
+            title, category, rng.randint(0, 9))
+        path = os.path.join(folder, name + '.cpp')
+        with open(path, 'w') as writer:
+            writer.write((header + u'#include <bits/stdc++.h>\nusing namespace std;\n' + ''.join(body)).encode('utf-8'))
+        sources.append(path)
+        if rng.random() < args.descriptions:
+            with open(os.path.join(folder, title + '.md'), 'w') as writer:
+                writer.write(MARKDOWN.format(title=title, name=name, count=rng.randint(1, 100)).encode('utf-8'))
+    return sources
+
+def description_path(source):
+    # Description matched by the title of a generated source
+    folder, name = os.path.split(os.path.splitext(source)[0])
+    return os.path.join(folder, name.replace('algorithm', 'algorithm-') + '.md')
+
+def run_build(root, argv, output=OUTPUT):
+    # Returns (wall time, timings report)
+    report = os.path.join(root, '.timings.json')
+    argv = [root, '-q', '-o', os.path.join(root, output), '--timings', 'json', '--timings-file', report] + argv
+    start = timer()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            docmeld.main(argv)
+        except SystemExit as e:
+            code = e.code if type(e.code) is int else (0 if e.code is None else 1)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    elapsed = timer() - start
+    if status != 0:
+        print('docmeld failed (status %s): %s' % (status, ' '.join(argv)))
+        exit(2)
+    with open(report, 'r') as reader:
+        return elapsed, json.load(reader)
+
+def prepare(scenario, root, sources, round):
+    cache = os.path.join(root, '.cache')
+    output = os.path.join(root, OUTPUT)
+    if scenario == 'cold':
+        if os.path.isdir(cache):
+            shutil.rmtree(cache)
+        if os.path.exists(output):
+            os.remove(output)
+    elif scenario == 'warm':
+        # Documents come from the cache, but the page is written again
+        if os.path.exists(output):
+            os.remove(output)
+    elif scenario == 'one-file-changed':
+        with open(sources[round % len(sources)], 'a') as writer:
+            writer.write('// changed in round %s\n' % round)
+    elif scenario == 'description-added':
+        # The first source without a description gets one
+        for source in sources:
+            path = description_path(source)
+            if not os.path.exists(path):
+                with open(path, 'w') as writer:
+                    writer.write(u'# Added in round %s\n' % round)
+                break
+
+def read_output(output):
+    # {relative path: content} of the page and of the fragments it loads, if split
+    with open(output, 'rb') as reader:
+        files = {OUTPUT: reader.read()}
+    folder = docmeld.fragment_folder(output)
+    if os.path.isdir(folder):
+        # Fragments of the previous build are kept for a while
+        for name in os.listdir(folder):
+            if name in files[OUTPUT]:
+                with open(os.path.join(folder, name), 'rb') as reader:
+                    files[os.path.join(os.path.basename(folder), name)] = reader.read()
+    return files
+
+def verify(scenario, root, argv):
+    # The incremental build must write the same page as a full one
+    run_build(root, argv + ['-n'], output=os.path.join(REFERENCE_FOLDER, OUTPUT))
+    actual = read_output(os.path.join(root, OUTPUT))
+    expected = read_output(os.path.join(root, REFERENCE_FOLDER, OUTPUT))
+    if actual != expected:
+        different = sorted(x for x in set(actual) | set(expected) if actual.get(x) != expected.get(x))
+        print('Scenario "%s": the output differs from a build without the cache: %s.' % (scenario, ', '.join(different)))
+        exit(2)
+
+def measure(scenario, root, sources, argv, rounds):
+    runs = []
+    best = None
+    for round in xrange(rounds):
+        prepare(scenario, root, sources, round)
+        elapsed, report = run_build(root, argv)
+        if scenario in CHECKED:
+            verify(scenario, root, argv)
+        runs.append(elapsed)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, report)
+    elapsed, report = best
+    return {
+        'best': elapsed,
+        'runs': runs,
+        'phases': dict((x['name'], x['wall']) for x in report['phases']),
+        'cache': report['cache'],
+        'peak_rss': report['peak_rss']
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Time docmeld builds of a generated template repository.')
+    parser.add_argument('-n', '--files', type=int, default=200, help='C++ sources (default: 200).')
+    parser.add_argument('--lines', type=int, default=120, help='approximate lines per source (default: 120).')
+    parser.add_argument('--slices', type=int, default=2, help='ACM_BEGIN/ACM_END blocks per source (default: 2).')
+    parser.add_argument('--categories', type=int, default=10, help='categories, one folder each (default: 10).')
+    parser.add_argument('--descriptions', type=float, default=0.5, help='fraction of sources with a Markdown description (default: 0.5).')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0).')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='builds per scenario, the best is reported (default: 3).')
+    parser.add_argument('-o', '--output', help='write the results as JSON into this file.')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown against the baseline (default: 0.25, i.e. 25%%).')
+    parser.add_argument('--keep', action='store_true', help='keep the generated repository.')
+    parser.add_argument('DOCMELD_OPTIONS', nargs=argparse.REMAINDER, help='extra options of docmeld.py after "--", e.g. "-- -H python -j 4".')
+    args = parser.parse_args()
+    argv = [x for x in args.DOCMELD_OPTIONS if x != '--']
+
+    root = tempfile.mkdtemp(prefix='docmeld-pipeline-')
+    try:
+        print('Generating %s sources in "%s"...' % (args.files, root))
+        sources = generate(root, args)
+        results = {
+            'docmeld': docmeld.__VERSION__,
+            'python': sys.version.split()[0],
+            'parameters': {
+                'files': args.files, 'lines': args.lines, 'slices': args.slices,
+                'categories': args.categories, 'descriptions': args.descriptions,
+                'seed': args.seed, 'rounds': args.rounds, 'options': argv
+            },
+            'scenarios': {}
+        }
+        for scenario in SCENARIOS:
+            results['scenarios'][scenario] = measure(scenario, root, sources, argv, args.rounds)
+    finally:
+        if args.keep:
+            print('Repository kept in "%s".' % root)
+        else:
+            shutil.rmtree(root)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as reader:
+            baseline = json.load(reader)['scenarios']
+    regressions = []
+    print('%-18s %10s %10s %12s %10s' % ('', 'best (ms)', 'hits', 'misses', 'baseline'))
+    for scenario in SCENARIOS:
+        result = results['scenarios'][scenario]
+        change = ''
+        if baseline is not None and scenario in baseline:
+            ratio = result['best'] / baseline[scenario]['best']
+            change = '%+.1f%%' % ((ratio - 1) * 100)
+            if ratio > 1 + args.threshold:
+                regressions.append(scenario)
+        print('%-18s %10.1f %10s %12s %10s' % (
+            scenario, result['best'] * 1000, result['cache']['hits'], result['cache']['misses'], change))
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump(results, writer, indent=2, sort_keys=True)
+    if regressions:
+        print('Slower than the baseline by more than %.0f%%: %s.' % (args.threshold * 100, ', '.join(regressions)))
+        exit(1)
+
+if __name__ == '__main__':
+    main()
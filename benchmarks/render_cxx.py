@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Token-to-HTML throughput of the former per-character renderer against
+# render_cxx(). Sources are lexed once by the Python highlighter, so only
+# HTML generation is timed (render_cxx() also parses the metainfo). Both
+# outputs must show the same text.
+#
+# Usage: benchmarks/render_cxx.py [-r ROUNDS] [DIRECTORY]
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import argparse
+import importlib
+
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import docmeld
+import default_preferences
+
+SAMPLE = r'''/**
+ * title: Segment Tree
+ * category: Data Structures
+ */
+#include <bits/stdc++.h>
+using namespace std;
+
+// 线段树：区间加、区间求和
+template <typename T>
+struct SegmentTree {
+    static const int N = 1 << 18;
+    T sum[N << 1], tag[N << 1];
+    void modify(int x, int l, int r, int L, int R, T v) {
+        if (L <= l && r <= R) { sum[x] += v * (r - l + 1); tag[x] += v; return; }
+        int m = (l + r) >> 1;
+        if (L <= m) modify(x << 1, l, m, L, R, v);
+        if (R > m) modify(x << 1 | 1, m + 1, r, L, R, v);
+        sum[x] = sum[x << 1] + sum[x << 1 | 1] + tag[x] * (r - l + 1);
+    }
+};
+
+int main() {
+    ios::sync_with_stdio(false);
+    printf("%d\n", (int) sizeof(SegmentTree<long long>) & 0xff);
+    return 0;
+}
+'''
+
+class Replay(object):
+    # Serves the tokens lexed beforehand
+    def __init__(self, results):
+        self.results = results
+
+    def tokenize(self, path, content):
+        return self.results[path]
+
+def legacy_get_tag(spelling):
+    NONE, ASCII, NON_ASCII = -1, 0, 1
+    tags = spelling.decode('utf-8').split('\n')
+    for i in xrange(len(tags)):
+        last = NONE
+        ret = []
+        for c in tags[i]:
+            t = NON_ASCII if ord(c) > 255 else ASCII
+            if t != last:
+                if t == NON_ASCII:
+                    ret.append(docmeld.config.TAG_BEGIN.format(name=docmeld.config.NON_ASCII_CLASS))
+                elif last != NONE:
+                    ret.append(docmeld.config.TAG_END)
+            ret.append(docmeld.config.REPLACEMENT.get(c, c))
+            last = t
+        if last == NON_ASCII:
+            ret.append(docmeld.config.TAG_END)
+        tags[i] = ''.join(ret)
+    return tags
+
+def legacy_render(path, content):
+    config = docmeld.config
+    tokens = docmeld.highlighter.tokenize(path, content)[0]
+    lines = content.split('\n')
+    line, column = 1, 1
+    buf = []
+    for k in xrange(len(tokens.kinds)):
+        while tokens.lines[k] != line:
+            buf.append(lines[line - 1][column - 1:].rstrip() + '\n')
+            line += 1
+            column = 1
+        if tokens.columns[k] != column:
+            tab_count = lines[line - 1][column - 1 : tokens.columns[k] - 1].count('\t')
+            length = tokens.columns[k] - column
+            buf.append(' ' * ((length - tab_count) + tab_count * config.TABSIZE))
+            column = tokens.columns[k]
+        tags = legacy_get_tag(docmeld.token_spelling(tokens, k))
+        kind = tokens.kinds[k]
+        classes = []
+        if kind == docmeld.TOKEN_KEYWORD:
+            classes.append(config.KEYWORD_CLASS)
+        if kind == docmeld.TOKEN_IDENTIFIER:
+            classes.append(config.IDENTIFIER_CLASS)
+        if kind == docmeld.TOKEN_COMMENT:
+            classes.append(config.COMMENT_CLASS)
+        if kind == docmeld.TOKEN_LITERAL:
+            classes.append(config.LITERAL_CLASS)
+        if kind == docmeld.TOKEN_PUNCTUATION:
+            classes.append(config.PUNCTUATION_CLASS)
+        if len(tags) == 1 and tags[0] in config.SPECIAL_MAP:
+            classes.append(config.SPECIAL_MAP[tags[0]])
+        for i in xrange(len(tags)):
+            tags[i] = '%s%s%s' % (config.TAG_BEGIN.format(name=' '.join(classes)), tags[i], config.TAG_END)
+        buf.append('\n'.join(tags))
+        line = tokens.end_lines[k]
+        column = tokens.end_columns[k]
+    if column != len(lines[line - 1]):
+        buf.append(lines[line - 1][column - 1:].rstrip())
+    return ''.join(buf)
+
+def current_render(path, content):
+    return docmeld.render_cxx(path, os.path.dirname(path), content)[0]
+
+def measure(render, sources, rounds):
+    best = None
+    for _ in xrange(rounds):
+        start = timer()
+        for path, content in sources:
+            render(path, content)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the former renderer with render_cxx().')
+    parser.add_argument('DIRECTORY', nargs='?', help='root directory of documents (with "preferences.py"); a built-in sample is used if omitted.')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='rounds, the best is reported (default: 5).')
+    args = parser.parse_args()
+
+    sources = []
+    if args.DIRECTORY is None:
+        docmeld.config = default_preferences
+        sources = [('sample-%s.cpp' % i, SAMPLE) for i in xrange(200)]
+    else:
+        os.chdir(args.DIRECTORY)
+        sys.path.append(os.getcwd())
+        docmeld.config = importlib.import_module(docmeld.PREFERENCE_MODULE)
+        for dirpath, dnames, fnames in os.walk('.'):
+            dnames[:] = [x for x in dnames if not x.startswith('.')]
+            for name in sorted(fnames):
+                if os.path.splitext(name)[1] in docmeld.config.FILE_EXTENSIONS:
+                    path = os.path.relpath(os.path.join(dirpath, name))
+                    with open(path, 'r') as reader:
+                        sources.append((path, reader.read()))
+    docmeld.DISABLE_DEBUG = True
+    docmeld.highlighter = docmeld.PythonHighlighter()
+    docmeld.initialize_parsers()
+    lexer = docmeld.highlighter
+    docmeld.highlighter = Replay(dict((path, lexer.tokenize(path, content)) for path, content in sources))
+    count = sum(len(docmeld.highlighter.results[path][0].kinds) for path, _ in sources)
+
+    tag_re = re.compile(r'<[^>]*>')
+    tags_before = tags_after = 0
+    for path, content in sources:
+        expected = legacy_render(path, content)
+        actual = current_render(path, content)
+        if tag_re.sub('', expected) != tag_re.sub('', actual):
+            print('Output text differs for "%s".' % path)
+            exit(1)
+        tags_before += len(tag_re.findall(expected))
+        tags_after += len(tag_re.findall(actual))
+    before = measure(legacy_render, sources, args.rounds)
+    after = measure(current_render, sources, args.rounds)
+    print('%s files, %s tokens' % (len(sources), count))
+    print('%-8s %12s %10s %10s' % ('', 'tokens/sec', 'time (ms)', 'HTML tags'))
+    print('%-8s %12.0f %10.1f %10s' % ('before', count / before, before * 1000, tags_before))
+    print('%-8s %12.0f %10.1f %10s   %.1fx' % ('after', count / after, after * 1000, tags_after, before / after))
+
+if __name__ == '__main__':
+    main()
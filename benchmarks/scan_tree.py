@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Scanning time of a synthetic document tree: the former os.walk() loop
+# (a stat() per file, IGNORES regexes one by one, isfile() probes for
+# description files) against scan_tree() and its directory index.
+#
+# Usage: benchmarks/scan_tree.py [-n FILES] [-r ROUNDS] [DIRECTORY]
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import shutil
+import fnmatch
+import argparse
+import tempfile
+
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import docmeld
+import default_preferences
+
+FILES_PER_FOLDER = 50
+IGNORES = ['README.md', 'readme.md', '*.o', 'build-*', 'tmp/*', '*.swp', '*~', 'a.out']
+
+def generate(root, count):
+    # Sources with and without descriptions, plus unrelated files
+    for i in xrange(count // FILES_PER_FOLDER):
+        folder = os.path.join(root, 'category-%s' % (i // 20), 'topic-%s' % i)
+        os.makedirs(folder)
+        for j in xrange(FILES_PER_FOLDER):
+            kind = j % 5
+            if kind in (0, 1):
+                name = 'algorithm-%s.cpp' % j
+            elif kind == 2:
+                name = 'algorithm-%s.md' % (j - 2)
+            elif kind == 3:
+                name = 'notes-%s.txt' % j
+            else:
+                name = 'build-%s.o' % j
+            with open(os.path.join(folder, name), 'w') as writer:
+                writer.write('// %s\n' % name)
+
+def legacy_scan(root):
+    patterns = [re.compile(fnmatch.translate(x)) for x in IGNORES]
+    def _ignored(path):
+        basename = os.path.basename(path)
+        for m in patterns:
+            for s in (basename, path):
+                r = m.match(s)
+                if r and r.end() == len(s):
+                    return True
+        return False
+
+    file_list = []
+    for dirpath, dnames, fnames in os.walk(root, followlinks=True):
+        dnames[:] = [x for x in dnames if not x.startswith('.')]
+        fnames[:] = [x for x in fnames if not x.startswith('.')]
+        dirname = os.path.relpath(dirpath, start=root)
+        for name in fnames:
+            path = os.path.relpath(os.path.join(dirpath, name), start=root)
+            if not _ignored(path):
+                statinfo = os.stat(path)
+                if statinfo.st_size <= docmeld.FILESIZE_LIMIT:
+                    _, ext = os.path.splitext(path)
+                    if ext in default_preferences.FILE_EXTENSIONS or \
+                       ext in default_preferences.DESCRIPTION_EXTENSIONS:
+                        file_list.append((dirname, path, ext))
+    return file_list
+
+def lookup_descriptions(file_list, exists):
+    found = 0
+    for dirname, path, ext in file_list:
+        if ext not in default_preferences.FILE_EXTENSIONS:
+            continue
+        title = os.path.basename(os.path.splitext(path)[0])
+        for desc_ext in default_preferences.DESCRIPTION_EXTENSIONS:
+            if exists(os.path.join(dirname, title + desc_ext)):
+                found += 1
+                break
+    return found
+
+def best(function, rounds):
+    result, elapsed = None, None
+    for _ in xrange(rounds):
+        start = timer()
+        result = function()
+        t = timer() - start
+        elapsed = t if elapsed is None else min(elapsed, t)
+    return result, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the os.walk() scanner with scan_tree().')
+    parser.add_argument('DIRECTORY', nargs='?', help='existing document tree to scan instead of a synthetic one.')
+    parser.add_argument('-n', '--files', type=int, default=50000, help='files in the synthetic tree (default: 50000).')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='rounds per scanner, the best is reported (default: 3).')
+    args = parser.parse_args()
+
+    docmeld.config = default_preferences
+    docmeld.DISABLE_DEBUG = True
+    docmeld.ignore_pattern = docmeld.compile_ignores(IGNORES)
+    temporary = None
+    if args.DIRECTORY is None:
+        temporary = tempfile.mkdtemp(prefix='docmeld-scan-')
+        print('Generating %s files in "%s"...' % (args.files, temporary))
+        generate(temporary, args.files)
+    root = os.path.abspath(args.DIRECTORY or temporary)
+    os.chdir(root)
+    print('scandir: %s' % ('available' if docmeld.scandir is not None else 'not available, listdir() used'))
+
+    try:
+        legacy, legacy_time = best(lambda: legacy_scan(root), args.rounds)
+        (current, _), current_time = best(docmeld.scan_tree, args.rounds)
+        if sorted(legacy) != sorted(current):
+            print('Scanners disagree: %s against %s files.' % (len(legacy), len(current)))
+            exit(1)
+        docmeld.directory_index = None
+        found, legacy_lookup = best(lambda: lookup_descriptions(legacy, os.path.isfile), args.rounds)
+        docmeld.scan_tree()
+        _, current_lookup = best(lambda: lookup_descriptions(current, docmeld.source_exists), args.rounds)
+
+        print('%-24s %12s %12s %8s' % ('', 'os.walk (ms)', 'scan_tree (ms)', 'speedup'))
+        print('%-24s %12.1f %12.1f %7.1fx' % (
+            'scan (%s files)' % len(current), legacy_time * 1000, current_time * 1000, legacy_time / current_time))
+        print('%-24s %12.1f %12.1f %7.1fx' % (
+            'descriptions (%s found)' % found, legacy_lookup * 1000, current_lookup * 1000, legacy_lookup / current_lookup))
+    finally:
+        if temporary is not None:
+            shutil.rmtree(temporary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# Load test of docmeld_webhook: signed GitHub-style push payloads for N
+# repositories with M branches each, plus a burst of rapid pushes to one
+# branch. Local bare repositories stand in for GitHub and are cloned
+# through file:// URLs. Requests go through Flask's test client, or to a
+# running uWSGI instance with --url. Reports request latency, build
+# throughput and error rates, and checks that the last push of every
+# branch ended up built.
+#
+# Usage: benchmarks/webhook_load.py [--repos N] [--branches M] [--pushes P] [--burst B] [--url URL --server-root DIR]
+
+import os
+import sys
+import json
+import hmac
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+SECRET = 'docmeld-load-test'
+FINISHED = ('success', 'fail', 'superseded')
+
+def git(cwd, *args):
+    return subprocess.check_output(['git'] + list(args), cwd=cwd, stderr=subprocess.STDOUT).decode().strip()
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+def parse_time(text):
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError(text)
+
+class Remote(object):
+    """A bare repository and one working clone per branch."""
+
+    def __init__(self, root, name, branches, highlighter):
+        self.name = name
+        self.bare = os.path.join(root, 'remotes', name + '.git')
+        self.clone_url = 'file://' + self.bare
+        self.work = {}
+        self.lock = threading.Lock()  # pushes to the bare repository
+        self.branch_locks = {branch: threading.Lock() for branch in branches}
+        source = os.path.join(root, 'remotes', name + '.src')
+        os.makedirs(source)
+        git(source, 'init', '-q')
+        git(source, 'config', 'user.email', 'load-test@localhost')
+        git(source, 'config', 'user.name', 'load-test')
+        with open(os.path.join(ROOT, 'default_preferences.py'), 'r') as reader:
+            preferences = reader.read()
+        if highlighter is not None:
+            preferences += f'\nHIGHLIGHTER = {highlighter!r}\n'
+        with open(os.path.join(source, 'preferences.py'), 'w') as writer:
+            writer.write(preferences)
+        with open(os.path.join(source, 'style.css'), 'w') as writer:
+            writer.write('.keyword { color: blue }\n')
+        for i in range(5):
+            with open(os.path.join(source, f'template-{i}.cpp'), 'w') as writer:
+                writer.write(f'/**\n * title: Template {i}\n * category: Load Test\n */\n'
+                             f'#include <cstdio>\nint main() {{ printf("{i}\\n"); return 0; }}\n')
+        git(source, 'add', '-A')
+        git(source, 'commit', '-q', '-m', 'Initial commit')
+        git(root, 'clone', '-q', '--bare', source, self.bare)
+        for branch in branches:
+            work = os.path.join(root, 'remotes', f'{name}.{branch}')
+            git(root, 'clone', '-q', self.bare, work)
+            git(work, 'config', 'user.email', 'load-test@localhost')
+            git(work, 'config', 'user.name', 'load-test')
+            git(work, 'checkout', '-q', '-b', branch)
+            with self.lock:
+                git(work, 'push', '-q', 'origin', branch)
+            self.work[branch] = work
+
+    def push(self, branch, index):
+        """Commit a change on `branch`, push it and return the payload."""
+        work = self.work[branch]
+        path = 'template-0.cpp'
+        with open(os.path.join(work, path), 'a') as writer:
+            writer.write(f'// push {index}\n')
+        message = f'Push {index} to {branch}'
+        git(work, 'commit', '-q', '-am', message)
+        before = git(work, 'rev-parse', 'HEAD~1')
+        head = git(work, 'rev-parse', 'HEAD')
+        with self.lock:
+            git(work, 'push', '-q', 'origin', branch)
+        commit = {
+            'id': head,
+            'message': message,
+            'timestamp': datetime.now().isoformat(),
+            'author': {'name': 'load-test', 'email': 'load-test@localhost'},
+            'added': [],
+            'removed': [],
+            'modified': [path]
+        }
+        return {
+            'ref': f'refs/heads/{branch}',
+            'before': before,
+            'after': head,
+            'repository': {
+                'name': self.name.rsplit('/', 1)[-1],
+                'full_name': self.name,
+                'clone_url': self.clone_url
+            },
+            'pusher': {'name': 'load-test'},
+            'commits': [commit],
+            'head_commit': commit
+        }
+
+class TestClient(object):
+    def __init__(self, application):
+        self.application = application
+        self.local = threading.local()
+
+    def request(self, method, path, data=None, headers=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.application.test_client()
+        response = client.open(path, method=method, data=data, headers=headers)
+        return response.status_code, response.get_data()
+
+class HTTPClient(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, data=None, headers=None):
+        request = urllib.request.Request(self.url + path, data=data, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+class LoadTest(object):
+    def __init__(self, client, route):
+        self.client = client
+        self.route = route
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = []
+        self.heads = {}  # {(repo, branch): last head pushed}
+
+    def post(self, event, payload):
+        data = json.dumps(payload).encode()
+        signature = 'sha1=' + hmac.new(SECRET.encode(), data, hashlib.sha1).hexdigest()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-Hub-Signature': signature
+        }
+        start = time.time()
+        status, body = self.client.request('POST', f'/{self.route}/', data, headers)
+        elapsed = time.time() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            if status not in (200, 202):
+                self.errors.append(f'{event} {payload["repository"]["full_name"]}: HTTP {status} {body[:200]!r}')
+        return status
+
+    def push(self, remote, branch, index):
+        # Payloads of a branch arrive in the order of the pushes, as from GitHub
+        with remote.branch_locks[branch]:
+            payload = remote.push(branch, index)
+            with self.lock:
+                self.heads[remote.name, branch] = payload['after']
+            self.post('push', payload)
+
+    def status(self, repo, branch):
+        query = urllib.parse.urlencode({'repo': repo, 'branch': branch})
+        status, body = self.client.request('GET', f'/{self.route}/status?{query}')
+        if status != 200:
+            raise RuntimeError(f'status query failed with HTTP {status}')
+        return json.loads(body)['jobs']
+
+def setup_server(root, args):
+    """Point docmeld_webhook at `root`, imported for the test client."""
+    sys.path.insert(0, ROOT)
+    import docmeld_webhook as webhook
+
+    executable = os.path.join(root, 'docmeld.sh')
+    with open(executable, 'w') as writer:
+        writer.write(f'#!/bin/sh\nexec {args.python} {os.path.join(ROOT, "docmeld.py")} "$@"\n')
+    os.chmod(executable, 0o755)
+    webhook.DOCMELD_EXECUTABLE = executable
+    webhook.DOCMELD_SOCKET = args.socket or os.path.join(root, 'no-build-server.socket')
+    webhook.WEBPAGE_DIRECTORY = os.path.join(root, 'www')
+    webhook.WEBURL = 'http://localhost/docmeld/'
+    webhook.TEMPORARY_INDEX_FILE = os.path.join(ROOT, 'nginx', 'temporary_index.html')
+    webhook.CACHE_DIRECTORY = os.path.join(root, webhook.DATABASE_DIRECTORY, 'cache')
+    webhook.QUEUE_WORKERS = args.workers
+    webhook.COMPILE_TIME_LIMIT = args.timeout
+    return webhook
+
+def write_records(database, remotes):
+    os.makedirs(database, exist_ok=True)
+    for remote in remotes:
+        record = {'secret': SECRET, 'last_build': '', 'checksums': {}}
+        path = os.path.join(database, hashlib.md5(remote.clone_url.encode()).hexdigest() + '.json')
+        with open(path, 'w') as writer:
+            json.dump(record, writer)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the docmeld webhook with local bare repositories.')
+    parser.add_argument('--repos', type=int, default=2, help='repositories (default: 2).')
+    parser.add_argument('--branches', type=int, default=2, help='branches per repository (default: 2).')
+    parser.add_argument('--pushes', type=int, default=3, help='pushes per branch, INTERVAL seconds apart (default: 3).')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between pushes to a branch (default: 1).')
+    parser.add_argument('--burst', type=int, default=5, help='extra pushes to the first branch, back to back (default: 5).')
+    parser.add_argument('--workers', type=int, default=2, help='build threads with the test client (default: 2).')
+    parser.add_argument('--timeout', type=int, default=300, help='seconds to wait for the builds (default: 300).')
+    parser.add_argument('--python', default='python2', help='interpreter running docmeld.py (default: python2).')
+    parser.add_argument('--highlighter', choices=['libclang', 'python'], help='HIGHLIGHTER of the generated repositories.')
+    parser.add_argument('--socket', help='build server socket ("docmeld.py --serve") used by the test client.')
+    parser.add_argument('--url', help='base URL of a running webhook (e.g. uWSGI with "--http :9090") instead of the test client.')
+    parser.add_argument('--server-root', help='with --url, working directory of that server, where the records are written.')
+    parser.add_argument('-o', '--output', help='write the report as JSON into this file.')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory.')
+    args = parser.parse_args()
+    if args.url and not args.server_root:
+        parser.error('--url requires --server-root.')
+
+    root = tempfile.mkdtemp(prefix='docmeld-webhook-load-')
+    try:
+        print(f'Creating {args.repos} repositories with {args.branches} branches in "{root}"...')
+        branches = [f'branch-{j}' for j in range(args.branches)]
+        remotes = [Remote(root, f'load-test/repo-{i}', branches, args.highlighter) for i in range(args.repos)]
+
+        if args.url:
+            write_records(os.path.join(args.server_root, 'database'), remotes)
+            client = HTTPClient(args.url)
+            route = 'docmeld-webhook'
+        else:
+            os.chdir(root)
+            webhook = setup_server(root, args)
+            write_records(webhook.DATABASE_DIRECTORY, remotes)
+            client = TestClient(webhook.application)
+            route = webhook.ROUTE
+        test = LoadTest(client, route)
+        for remote in remotes:
+            test.post('ping', {'repository': {'full_name': remote.name, 'clone_url': remote.clone_url}})
+
+        def _branch(remote, branch, pushes):
+            for k in range(pushes):
+                test.push(remote, branch, k)
+                time.sleep(args.interval)
+
+        def _burst(remote, branch):
+            for k in range(args.burst):
+                test.push(remote, branch, args.pushes + k)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.repos * args.branches + 1) as executor:
+            futures = [executor.submit(_branch, remote, branch, args.pushes)
+                       for remote in remotes for branch in branches]
+            futures.append(executor.submit(_burst, remotes[0], branches[0]))
+            for future in futures:
+                future.result()
+        pushed = time.time() - start
+
+        print('Waiting for the builds...')
+        deadline = time.time() + args.timeout
+        while True:
+            jobs = [job for remote in remotes for branch in branches for job in test.status(remote.name, branch)]
+            if all(job['state'] in FINISHED for job in jobs):
+                break
+            if time.time() > deadline:
+                test.errors.append('builds still running after the timeout')
+                break
+            time.sleep(0.5)
+        elapsed = time.time() - start
+
+        states = {}
+        durations = []
+        for job in jobs:
+            states[job['state']] = states.get(job['state'], 0) + 1
+            if job['state'] == 'fail':
+                test.errors.append(f'job #{job["id"]} {job["repo"]}/{job["branch"]} failed: {job["result"]}')
+            if job['started_at'] and job['finished_at'] and job['state'] != 'superseded':
+                durations.append((parse_time(job['finished_at']) - parse_time(job['started_at'])).total_seconds())
+        # The last push of every branch must be the one built last
+        stale = []
+        for remote in remotes:
+            for branch in branches:
+                built = [job for job in test.status(remote.name, branch) if job['state'] == 'success']
+                if not built or built[0]['head'] != test.heads[remote.name, branch]:
+                    stale.append(f'{remote.name}/{branch}')
+        for name in stale:
+            test.errors.append(f'{name}: last push not built')
+        builds = states.get('success', 0) + states.get('fail', 0)
+        report = {
+            'parameters': vars(args),
+            'requests': {
+                'count': len(test.latencies),
+                'errors': len(test.errors),
+                'latency_p50': percentile(test.latencies, 0.5),
+                'latency_p95': percentile(test.latencies, 0.95),
+                'latency_max': percentile(test.latencies, 1)
+            },
+            'builds': {
+                'states': states,
+                'throughput': builds / elapsed,
+                'duration_p50': percentile(durations, 0.5),
+                'duration_p95': percentile(durations, 0.95),
+                'error_rate': states.get('fail', 0) / builds if builds else None
+            },
+            'stale_branches': stale,
+            'push_time': pushed,
+            'total_time': elapsed,
+            'errors': test.errors
+        }
+    finally:
+        if args.keep:
+            print(f'Kept "{root}".')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    requests, built = report['requests'], report['builds']
+    print(f'requests: {requests["count"]}, latency p50 {requests["latency_p50"] * 1000:.1f} ms, '
+          f'p95 {requests["latency_p95"] * 1000:.1f} ms, max {requests["latency_max"] * 1000:.1f} ms')
+    print(f'jobs: {", ".join(f"{n} {s}" for s, n in sorted(built["states"].items()))}; '
+          f'{built["throughput"]:.2f} builds/s over {report["total_time"]:.1f} s')
+    if built['duration_p50'] is not None:
+        print(f'build time p50 {built["duration_p50"]:.1f} s, p95 {built["duration_p95"]:.1f} s')
+    for error in report['errors']:
+        print(f'error: {error}')
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump(report, writer, indent=2, sort_keys=True)
+    if report['errors']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
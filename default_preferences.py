@@ -3,14 +3,19 @@
 # Project Setting
 DOCUMENT_TITLE = "Reference Document"
 OUTPUT_PATH = 'output.html'
+SPLIT_OUTPUT = False  # index page plus categories loaded on demand; same as "--split"
 ASSETS = ['style.css']
 IGNORES = ['README.md', 'readme.md']
 
 # Clang Settings
+HIGHLIGHTER = 'libclang'  # or 'python' (built-in lexer, no libclang needed)
 LIBCLANG_PATH = '/usr/lib/llvm-6.0/lib/libclang.so.1'
 CLANG_ARGS = ['-std=c++14', '-x', 'c++']
+FAST_PARSE = False  # lex the main file only; same as "--fast"
+PRECOMPILED_HEADER = True  # precompile <...> headers shared by source files
 
 # CSS Settings
+COMPACT_OUTPUT = False  # CSS-counter line numbers and short class names; same as "--compact"
 CODE_BLOCK_CLASS = 'code-block'
 LINE_CLASS = 'line'
 LINE_NUMBER_CLASS = 'number'
@@ -82,6 +87,7 @@ REPLACEMENT = {
 
 # Generator Settings
 CACHE_DIRECTORY = '.cache'
+CACHE_SIZE_LIMIT = 128 * 1024 * 1024  # least recently used entries beyond are evicted
 BLOCK_BEGIN_MARCO = 'ACM_BEGIN'
 BLOCK_END_MARCO = 'ACM_END'
 
@@ -112,7 +118,13 @@ WEBPAGE_TEMPLATE = u'''<!DOCTYPE html><html><head>
   <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.11.0/dist/katex.min.css" integrity="sha384-BdGj8xC2eZkQaxoQ8nSLefg4AV4/AwB3Fj+8SUSo7pnKP6Eoy18liIKTPn9oBYNG" crossorigin="anonymous">
   <script defer src="https://cdn.jsdelivr.net/npm/katex@0.11.0/dist/katex.min.js" integrity="sha384-JiKN5O8x9Hhs/UE5cT5AAJqieYlOZbGT3CHws/y97o3ty4R7/O5poG9F3JoiOYw1" crossorigin="anonymous"></script>
   <script defer src="https://cdn.jsdelivr.net/npm/katex@0.11.0/dist/contrib/auto-render.min.js" integrity="sha384-kWPLUVMOks5AQFrykwIup5lo0m3iMkkHrD0uJ4H5cjeGihAutqP0yW0J6dpFiVkI" crossorigin="anonymous"
-    onload="renderMathInElement(document.body, options={{delimiters: [{{ left: '$$', right: '$$', display: true }}, {{ left: '$', right: '$', display: false }}]}})"></script>
+    onload="renderMathInElement(document.body, KATEX_OPTIONS)"></script>
+  <script>
+    var KATEX_OPTIONS = {{delimiters: [{{ left: '$$', right: '$$', display: true }}, {{ left: '$', right: '$', display: false }}]}};
+    document.addEventListener('docmeld-fragment', function (event) {{
+      if (window.renderMathInElement) renderMathInElement(event.target, KATEX_OPTIONS);
+    }});
+  </script>
   <link rel="stylesheet" type="text/css" href="style.css">
   <title>{document_title}</title>
 </head><body>
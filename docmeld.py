@@ -9,6 +9,10 @@ FILESIZE_LIMIT = 32 * 1024  # 32KB
 
 DISABLE_CACHE = False
 DISABLE_DEBUG = True
+FAST_PARSE = False
+COMPACT_OUTPUT = False
+SPLIT_OUTPUT = False
+SHOW_DIAGNOSTICS = False
 
 PREFERENCE_MODULE = 'preferences'
 
@@ -21,6 +25,12 @@ SYSTEM_LIBCLANG = []
 LIBCLANG_NO_USER_SPECIFIED = False
 LIBCLANG_PRIORITIZE_USER_CONFIG = True
 LIBCLANG_SEARCH_BY_LOCATE = True
+# CXTranslationUnit_SingleFileParse (libclang >= 5.0), not exported by the
+# Python bindings: skip all #include directives and parse the main file only
+LIBCLANG_PARSE_SINGLE_FILE = 0x400
+
+import time
+IMPORT_STARTED = time.time()
 
 import os
 import os.path
@@ -31,18 +41,31 @@ import fnmatch
 import argparse
 import hashlib
 import shutil
+import urllib
 import importlib
+import imp
+import fcntl
+import pipes
 import subprocess
+import sqlite3
+import multiprocessing
+import signal
+import resource
+import cProfile
+import SocketServer
 
 import itertools
 zip = itertools.izip
 
+from array import array
+
 try:
     import cPickle as pickle
 except:
     import pickle
 
 from sys import argv
+from datetime import datetime
 from colorama import Fore
 from collections import defaultdict, namedtuple
 
@@ -96,6 +119,9 @@ def md5(x):
         x = x.encode('utf-8')
     return hashlib.md5(x).hexdigest()
 
+def blob_sha1(content):
+    return hashlib.sha1('blob %s\0%s' % (len(content), content)).hexdigest()
+
 def checksum(signature, content):
     method, digest = signature.split('=', 1)
     if method not in hashlib.algorithms_available:
@@ -108,245 +134,1117 @@ def checksum(signature, content):
     return digest == evaluated
 
 # Ignores
+def scan_file(path, size):
+    # Extension of a file to be compiled, or None if skipped
+    if ignored(path):
+        DEBUG('"%s" ignored due to IGNORES list.' % path)
+        return None
+    if size > FILESIZE_LIMIT:
+        DEBUG('"%s" ignored due to file size limitation.' % path)
+        return None
+    _, ext = os.path.splitext(path)
+    if ext in config.FILE_EXTENSIONS or ext in config.DESCRIPTION_EXTENSIONS:
+        return ext
+    return None
+
+ignore_pattern = None
+
+def compile_ignores(patterns):
+    # All patterns fused into one alternation. fnmatch.translate() appends
+    # global flags in Python 2, which may only appear once.
+    parts = []
+    for x in patterns:
+        x = fnmatch.translate(x)
+        if x.endswith('(?ms)'):
+            x = x[:-len('(?ms)')]
+        parts.append(x)
+    return re.compile('(?ms)(?:%s)' % '|'.join(parts)) if parts else None
+
 def ignored(path):
-    def _matched(m, s):
-        r = m.match(s)
-        return r and r.end() == len(s)
-    basename = os.path.basename(path)
-    for m in config.IGNORES:
-        if _matched(m, basename) or _matched(m, path):
-            return True
-    return False
+    if ignore_pattern is None:
+        return False
+    return bool(ignore_pattern.match(os.path.basename(path)) or ignore_pattern.match(path))
 
-# Cache Management
-def load_cache(content, name):
-    global DISABLE_CACHE
+# File Scanner
+# Directories are listed with scandir() where available (Python 3.5+, or the
+# "scandir" backport), which tells directories apart without a stat() per
+# entry. Names of every scanned directory are kept in memory, so looking
+# for description files does not touch the disk again.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-    if type(content) is unicode:
-        content = content.encode(config.ENCODING)
+directory_index = None  # {dirname: set(file names)} after scan_tree()
+
+def list_directory(path):
+    # (name, is directory) of all entries, following symbolic links
+    if scandir is None:
+        return [(x, os.path.isdir(os.path.join(path, x))) for x in os.listdir(path)]
+    result = []
+    for entry in scandir(path):
+        try:
+            result.append((entry.name, entry.is_dir()))
+        except OSError:
+            result.append((entry.name, False))
+    return result
+
+def scan_tree():
+    """Scan the current directory for files to compile, in the same order as
+    os.walk(). Returns [(dirname, path, ext)] and {path: [size, mtime]}."""
+    global directory_index
+
+    if scandir is None:
+        WARN('"scandir" is not available. Scanning with os.listdir() is slower: please install the "scandir" package.')
+    file_list = []
+    stats = {}
+    directory_index = {}
+    visited = set()  # (device, inode) of scanned directories
+    stack = [os.curdir]
+    while stack:
+        dirname = stack.pop()
+        try:
+            statinfo = os.stat(dirname)
+            entries = list_directory(dirname)
+        except OSError as e:
+            WARN('Failed to scan "%s". [%s] %s' % (dirname, type(e), e))
+            continue
+        if (statinfo.st_dev, statinfo.st_ino) in visited:
+            WARN('"%s" was scanned through another symbolic link. Skipped.' % dirname)
+            continue
+        visited.add((statinfo.st_dev, statinfo.st_ino))
+
+        names = set()
+        folders = []
+        for name, is_dir in entries:
+            path = name if dirname == os.curdir else os.path.join(dirname, name)
+            if is_dir:
+                # Skip hidden directories
+                if not name.startswith('.'):
+                    folders.append(path)
+                continue
+            names.add(name)
+            _, ext = os.path.splitext(name)
+            if name.startswith('.') or \
+               (ext not in config.FILE_EXTENSIONS and ext not in config.DESCRIPTION_EXTENSIONS):
+                continue
+            try:
+                statinfo = os.stat(path)
+            except OSError:
+                DEBUG('"%s" is a broken link. Skipped.' % path)
+                continue
+            if scan_file(path, statinfo.st_size) is not None:
+                file_list.append((dirname, path, ext))
+                stats[path.decode(config.PATH_ENCODING)] = [statinfo.st_size, statinfo.st_mtime]
+        directory_index[dirname] = names
+        stack.extend(reversed(folders))
+    return (file_list, stats)
+
+# Cache Management
+# Entries live in one SQLite database in CACHE_DIRECTORY, keyed by
+# md5(fingerprint + name + git blob id of content) and stored as binary pickles. The
+# fingerprint covers every setting that affects the rendered output, so a
+# changed setting simply misses. WAL journaling keeps the store consistent
+# if a build is killed, and lets parallel workers read while one writes.
+# Other files in CACHE_DIRECTORY (precompiled headers) share the size
+# budget; their mtime is their last use.
+CACHE_DATABASE = 'cache.sqlite3'
+CACHE_FINGERPRINT = ''
+CACHE_BATCH_SIZE = 500  # below SQLITE_MAX_VARIABLE_NUMBER
+DEFAULT_CACHE_SIZE_LIMIT = 128 * 1024 * 1024  # 128MB
+# A cache directory shared by all builds on a server, e.g. by forks of the
+# same library. Overrides CACHE_DIRECTORY in preferences.py.
+CACHE_DIRECTORY_ENV = 'DOCMELD_CACHE_DIR'
+RENDERER_VERSION = 4  # changes of the generated HTML invalidate the cache
+CACHE_SETTINGS = [
+    'CLANG_ARGS', 'HIGHLIGHTER', 'TAG_BEGIN', 'TAG_END', 'KEYWORD_CLASS',
+    'IDENTIFIER_CLASS', 'COMMENT_CLASS', 'LITERAL_CLASS', 'PUNCTUATION_CLASS',
+    'NON_ASCII_CLASS', 'SPECIAL', 'REPLACEMENT', 'TABSIZE', 'ENCODING',
+    'PATH_ENCODING', 'BLOCK_BEGIN_MARCO', 'BLOCK_END_MARCO',
+    'NAMEMETA_SEPARATER', 'NAMEMETA_KEYS', 'META_TITLE', 'META_DESCRIPTION',
+    'DESCRIPTION_EXTENSIONS', 'MARKDOWN_EXTENSIONS'
+]
+
+cache_connection = None
+cache_connection_pid = None
+cache_prefetched = {}  # {cache key: whether it is in the store}, values are fetched one by one
+cache_keys = {}  # {path: cache key} of the files looked up by prefetch_cache()
+cache_hits = 0
+cache_misses = 0
+
+def render_fingerprint(highlighter_name):
+    def _describe(x):
+        # Markdown extensions may be given as objects
+        configs = x.getConfigs() if hasattr(x, 'getConfigs') else {}
+        return ['%s.%s' % (type(x).__module__, type(x).__name__), configs]
+    settings = dict((key, getattr(config, key, None)) for key in CACHE_SETTINGS)
+    settings['HIGHLIGHTER'] = highlighter_name
+    settings['FAST_PARSE'] = FAST_PARSE
+    settings['COMPACT_OUTPUT'] = COMPACT_OUTPUT
+    settings['__VERSION__'] = __VERSION__
+    settings['RENDERER_VERSION'] = RENDERER_VERSION
+    return md5(json.dumps(settings, sort_keys=True, default=_describe))
+
+def cache_key(content, name, blob=None):
+    # Keyed by git blob id, so that sources read from git objects need no rehashing
     if type(name) is unicode:
         name = name.encode(config.PATH_ENCODING)
-    key = md5(name + content)
+    if blob is None:
+        if type(content) is unicode:
+            content = content.encode(config.ENCODING)
+        blob = blob_sha1(content)
+    return md5(CACHE_FINGERPRINT + name + blob)
+
+def source_key(path):
+    # Keys of prefetched files are not computed again
+    if path in cache_keys:
+        return cache_keys[path]
+    if source_tree is not None:
+        return cache_key(None, path, blob=source_tree.blob(path))
+    return cache_key(read_source(path), path)
+
+def open_cache():
+    global cache_connection
+    global cache_connection_pid
+
+    # SQLite connections must not cross fork()
+    if cache_connection is not None and cache_connection_pid == os.getpid():
+        return cache_connection
+    if not os.path.exists(config.CACHE_DIRECTORY):
+        os.makedirs(config.CACHE_DIRECTORY)
+    path = os.path.join(config.CACHE_DIRECTORY, CACHE_DATABASE)
+    try:
+        cache_connection = connect_cache(path)
+    except sqlite3.OperationalError:
+        # Busy or unreadable, which does not mean corrupted
+        raise
+    except sqlite3.DatabaseError as e:
+        WARN('Cache database "%s" is corrupted and will be rebuilt. [%s] %s' % (path, type(e), e))
+        os.rename(path, path + '.corrupted')
+        cache_connection = connect_cache(path)
+    cache_connection_pid = os.getpid()
+    return cache_connection
+
+def connect_cache(path):
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS entries ('
+        'key TEXT PRIMARY KEY, version TEXT, fingerprint TEXT, '
+        'value BLOB, size INTEGER, used REAL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+    return connection
+
+def prefetch_cache(paths):
+    """Look up the entries of all `paths` in one pass. Returns the paths missing the cache."""
+    grouped = defaultdict(list)
+    cache_keys.clear()
+    for path in paths:
+        cache_keys[path] = source_key(path)
+        grouped[cache_keys[path]].append(path)
+    connection = open_cache()
+    now = time.time()
+    hits = []
+    keys = list(grouped)
+    for i in xrange(0, len(keys), CACHE_BATCH_SIZE):
+        batch = keys[i:i + CACHE_BATCH_SIZE]
+        rows = connection.execute(
+            'SELECT key FROM entries WHERE key IN (%s)' % ', '.join('?' * len(batch)), batch)
+        hits.extend(key for key, in rows)
+    cache_prefetched.clear()
+    cache_prefetched.update((key, False) for key in keys)
+    cache_prefetched.update((key, True) for key in hits)
+    connection.execute('BEGIN IMMEDIATE')
+    for i in xrange(0, len(hits), CACHE_BATCH_SIZE):
+        batch = hits[i:i + CACHE_BATCH_SIZE]
+        connection.execute(
+            'UPDATE entries SET used = ? WHERE key IN (%s)' % ', '.join('?' * len(batch)), [now] + batch)
+    connection.execute('COMMIT')
+    DEBUG('Cache prefetched: %s of %s files hit.' % (len(hits), len(keys)))
+    return set(path for key in keys if not cache_prefetched[key] for path in grouped[key])
+
+def load_cache(path):
+    global DISABLE_CACHE
+
+    global cache_misses
+
+    key = source_key(path)
+    if DISABLE_CACHE:
+        cache_misses += 1
+        return (key, False, None)
+    flag, result = fetch_cache(key)
+    return (key, flag, result)
+
+def fetch_cache(key, count=True):
+    global cache_hits
+    global cache_misses
+
+    if cache_prefetched.get(key) is False:
+        cache_misses += count
+        return (False, None)
+    connection = open_cache()
+    row = connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        cache_misses += count
+        return (False, None)
+    try:
+        result = pickle.loads(str(row[0]))
+    except Exception as e:
+        WARN('Corrupted cache entry "%s". [%s] %s' % (key, type(e), e))
+        cache_misses += count
+        return (False, None)
+    if key not in cache_prefetched:
+        # Prefetched entries are marked as used already
+        connection.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+    cache_hits += count
+    return (True, result)
+
+def write_cache(key, result):
+    value = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    open_cache().execute(
+        'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+        (key, __VERSION__, CACHE_FINGERPRINT, sqlite3.Binary(value), len(value), time.time()))
+    if key in cache_prefetched:
+        cache_prefetched[key] = True
+
+def list_cache():
+    entries = []  # (last use, size, is file, key or path)
+    connection = open_cache()
+    for used, size, key in connection.execute('SELECT used, size, key FROM entries'):
+        entries.append((used, size, False, key))
+    for name in os.listdir(config.CACHE_DIRECTORY):
+        if name in (CACHE_DATABASE, CACHE_DATABASE + '-wal', CACHE_DATABASE + '-shm') or \
+           name.startswith(MANIFEST_PREFIX):
+            continue
+        path = os.path.join(config.CACHE_DIRECTORY, name)
+        try:
+            statinfo = os.stat(path)
+            used = statinfo.st_mtime
+            if name.startswith('pch-') and name.endswith('.hpp') and os.path.isfile(path[:-len('.hpp')]):
+                # The prelude of a precompiled header is used with it
+                used = os.path.getmtime(path[:-len('.hpp')])
+        except OSError:
+            continue
+        entries.append((used, statinfo.st_size, True, path))
+    return sorted(entries)
+
+def prune_cache(limit):
+    entries = list_cache()
+    total = sum(size for _, size, _, _ in entries)
+    evicted_keys = []
+    evicted_files = 0
+    for _, size, is_file, location in entries:
+        if total <= limit:
+            break
+        DEBUG('Evict "%s" (%s bytes).' % (location, size))
+        if is_file:
+            try:
+                os.remove(location)
+            except OSError:
+                continue
+            evicted_files += 1
+        else:
+            evicted_keys.append(location)
+        total -= size
+    connection = open_cache()
+    connection.execute('BEGIN IMMEDIATE')
+    for i in xrange(0, len(evicted_keys), CACHE_BATCH_SIZE):
+        batch = evicted_keys[i:i + CACHE_BATCH_SIZE]
+        connection.execute('DELETE FROM entries WHERE key IN (%s)' % ', '.join('?' * len(batch)), batch)
+    connection.execute('COMMIT')
+    if evicted_keys:
+        connection.execute('PRAGMA incremental_vacuum')
+    return len(evicted_keys) + evicted_files, total
+
+# Build Manifest
+# Records, per output file, the inputs of the last build as
+# {path: [size, mtime, md5]}, the stat of the output and, for each source,
+# the cache key of its resolved document, its description path, title,
+# category and rank. Inputs with unchanged size and mtime are not read again.
+MANIFEST_PREFIX = 'manifest-'
+MANIFEST_VERSION = 2
+
+def manifest_path(output_path):
+    return os.path.join(config.CACHE_DIRECTORY, '%s%s.json' % (MANIFEST_PREFIX, md5(output_path)))
+
+def load_manifest(path):
+    try:
+        with open(path, 'r') as reader:
+            return json.load(reader)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
     if not os.path.exists(config.CACHE_DIRECTORY):
         os.makedirs(config.CACHE_DIRECTORY)
-    path = os.path.join(config.CACHE_DIRECTORY, key)
-    return (path, False if DISABLE_CACHE else os.path.exists(path))
+    temporary = '%s.%s.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as writer:
+        json.dump(manifest, writer)
+    os.rename(temporary, path)
+
+def stat_file(path):
+    statinfo = os.stat(path)
+    return [statinfo.st_size, statinfo.st_mtime]
+
+def stat_assets():
+    stats = {}
+    if source_tree is not None:
+        for name in config.ASSETS:
+            for path in source_tree.find(name):
+                stats[path.decode(config.PATH_ENCODING)] = source_tree.stat(path)
+        return stats
+    for name in config.ASSETS:
+        if os.path.isfile(name):
+            stats[name.decode(config.PATH_ENCODING)] = stat_file(name)
+        elif os.path.isdir(name):
+            for dirpath, dnames, fnames in os.walk(name):
+                for fname in fnames:
+                    path = os.path.join(dirpath, fname)
+                    stats[path.decode(config.PATH_ENCODING)] = stat_file(path)
+    return stats
+
+def build_fingerprint():
+    return md5(CACHE_FINGERPRINT + str(MANIFEST_VERSION) + read_source(PREFERENCE_MODULE + '.py'))
+
+def manifest_up_to_date(manifest, fingerprint, stats, output_path):
+    if manifest.get('fingerprint') != fingerprint:
+        return False
+    if not os.path.isfile(output_path) or manifest.get('output') != stat_file(output_path):
+        return False
+    fragments = manifest.get('fragments', [])
+    if SPLIT_OUTPUT != bool(fragments):
+        return False
+    for name in fragments:
+        if not os.path.isfile(os.path.join(fragment_folder(output_path), name)):
+            return False
+    inputs = manifest.get('inputs', {})
+    if len(inputs) != len(stats):
+        return False
+    for path, stat in stats.items():
+        if path not in inputs or inputs[path][:2] != stat:
+            return False
+    return True
+
+def hash_inputs(stats, previous):
+    inputs = {}
+    for path, stat in stats.items():
+        old = previous.get(path)
+        if old is not None and old[:2] == stat:
+            inputs[path] = old
+        elif source_tree is not None:
+            inputs[path] = stat + [source_tree.blob(path.encode(config.PATH_ENCODING))]
+        else:
+            with open(path.encode(config.PATH_ENCODING), 'rb') as reader:
+                inputs[path] = stat + [md5(reader.read())]
+    return inputs
+
+def load_changes(path):
+    # Either a list of paths or {"added": [...], "modified": [...], "removed": [...]}
+    with open(path, 'r') as reader:
+        data = json.load(reader)
+    if isinstance(data, dict):
+        data = data.get('added', []) + data.get('modified', []) + data.get('removed', [])
+    return set(os.path.normpath(x) for x in data)
+
+def rebuild_required(manifest, fingerprint, changes):
+    if manifest.get('fingerprint') != fingerprint or 'files' not in manifest:
+        return True
+    for path in changes:
+        if path == PREFERENCE_MODULE + '.py':
+            return True
+        for name in config.ASSETS:
+            name = os.path.normpath(name.decode(config.PATH_ENCODING))
+            if path == name or path.startswith(name + os.sep):
+                return True
+    return False
+
+def document_key(fingerprint, inputs, path, desc_path):
+    def _hash(x):
+        return inputs[x][2] if x in inputs else None
+    return md5(fingerprint + json.dumps([path, _hash(path), desc_path, _hash(desc_path)]))
 
 # Basic Git manipulations
-def git_clone(url, dest):
+# All branches of a repository share one bare clone, "cloned/<md5(url)>",
+# and each branch is built in its own worktree under
+# "cloned/<md5(url)>.worktrees/". Commits are fetched by SHA and worktrees
+# are hard reset to it, so builds of different branches do not interfere.
+git_worktree_lock = None
+
+def git_lock(path):
+    # Exclusive until closed or the process exits
+    lock = open(path + '.lock', 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+def git_clone(url, dest, options=''):
     INFO('Cloning repository "%s"...' % url)
-    return sh('%s clone %s %s' % (GIT_EXECUTABLE, url, dest))
-
-def git_has_branch(branch):
-    result = subprocess.check_output([GIT_EXECUTABLE, 'branch', '-l', '-a']).strip().split('\n')
-    li = [x.rsplit('/', 1)[-1] for x in result]
-    return branch in li
+    return sh('%s clone --bare -q %s %s %s' % (GIT_EXECUTABLE, options, pipes.quote(url), pipes.quote(dest)))
 
 def git_create_branch(branch):
     return sh('%s branch %s' % (GIT_EXECUTABLE, branch))
 
-def git_checkout(branch):
-    INFO('Checking out branch "%s"...' % branch)
-    return sh('%s checkout %s -q' % (GIT_EXECUTABLE, branch))
-
-def git_pull(branch):
-    INFO('Pulling data of branch "%s" from remote...' % branch)
-    return sh('%s pull origin %s' % (GIT_EXECUTABLE, branch))
+def git_fetch(branch, head=None, options=''):
+    # Commit fetched for "branch", or exactly "head" if given
+    if head is not None:
+        INFO('Fetching commit %s from remote...' % head)
+        if sh('%s fetch -q %s origin %s' % (GIT_EXECUTABLE, options, pipes.quote(head))) == 0:
+            return git_rev_parse(head)
+        WARN('Remote refused to fetch commit %s. Fetching branch "%s".' % (head, branch))
+    else:
+        INFO('Fetching branch "%s" from remote...' % branch)
+    refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch)
+    if sh('%s fetch -q %s origin %s' % (GIT_EXECUTABLE, options, pipes.quote(refspec))) != 0:
+        return None
+    return git_rev_parse(head or 'origin/%s' % branch)
+
+def git_worktree_add(folder, commit):
+    INFO('Creating worktree "%s"...' % folder)
+    sh('%s worktree prune' % GIT_EXECUTABLE)
+    return sh('%s worktree add -f --detach %s %s' % (GIT_EXECUTABLE, pipes.quote(folder), commit))
+
+def git_reset(commit):
+    INFO('Resetting to commit %s...' % commit)
+    return sh('%s reset -q --hard %s' % (GIT_EXECUTABLE, commit))
+
+def git_rev_parse(revision):
+    with open(os.devnull, 'w') as devnull:
+        try:
+            return subprocess.check_output(
+                [GIT_EXECUTABLE, 'rev-parse', '--verify', '-q', revision + '^{commit}'], stderr=devnull).strip()
+        except (subprocess.CalledProcessError, OSError):
+            return None
+
+def git_changed_files(since):
+    # Relative to the current directory, which may be a subdirectory of the
+    # repository. Paths outside it are left out.
+    result = subprocess.check_output(
+        [GIT_EXECUTABLE, 'diff', '--name-only', '--no-renames', '--relative', '-z', since, 'HEAD'])
+    return set(x.decode(config.PATH_ENCODING) for x in result.split('\0') if x)
 
 def git_get_head_sha1():
     result = subprocess.check_output([GIT_EXECUTABLE, 'rev-parse', 'HEAD']).strip()
     DEBUG('Current HEAD: %s' % result)
     return result
 
-def handle_git_url(url, branch, head):
+def handle_git_url(url, branch, head, checkout=True, depth=None, filter=None):
+    global git_worktree_lock
+
     ERROR_CODE = 8
     url = url[len(GIT_URL_START):]
-    folder = os.path.join(GIT_REPO_DIRECTORY, md5(url))
+    folder = os.path.abspath(os.path.join(GIT_REPO_DIRECTORY, md5(url)))
+    worktree = os.path.join(folder + '.worktrees', md5(branch))
     DEBUG('Repository saved to "%s".' % folder)
-    updated = False
-    if not os.path.exists(folder):
-        if git_clone(url, folder) != 0:
-            ERROR('Unable to clone the repo "%s".' % url)
-            exit(ERROR_CODE)
-        updated = True
+    options = ''
+    if depth is not None:
+        options += ' --depth %s' % depth
+    if filter is not None:
+        options += ' --filter=%s' % pipes.quote(filter)
+    if checkout:
+        # Builds of the same branch take turns
+        if not os.path.exists(folder + '.worktrees'):
+            os.makedirs(folder + '.worktrees')
+        git_worktree_lock = git_lock(worktree)
     cwd = os.getcwd()
-    os.chdir(folder)
-    # DEBUG(os.path.abspath(folder))
-    if not git_has_branch(branch):
-        ERROR('No branch named "%s" found.')
-        exit(ERROR_CODE)
-    if git_checkout(branch) != 0:
-        ERROR('Unable to checkout the branch "%s".' % branch)
-        exit(ERROR_CODE)
-    if not updated and git_pull(branch) != 0:
-        ERROR('Unable to pull from remote on branch "%s".' % branch)
+    with git_lock(folder):
+        if not os.path.exists(folder):
+            if git_clone(url, folder, options) != 0:
+                ERROR('Unable to clone the repo "%s".' % url)
+                exit(ERROR_CODE)
+        os.chdir(folder)
+        commit = git_fetch(branch, head, options)
+        if commit is None:
+            ERROR('Unable to fetch branch "%s" from remote.' % branch)
+            exit(ERROR_CODE)
+        if not checkout:
+            # Sources are read from git objects
+            os.chdir(cwd)
+            return folder
+        if not os.path.exists(os.path.join(worktree, '.git')) and git_worktree_add(worktree, commit) != 0:
+            ERROR('Unable to create a worktree for branch "%s".' % branch)
+            exit(ERROR_CODE)
+    os.chdir(worktree)
+    if git_reset(commit) != 0:
+        ERROR('Unable to reset branch "%s" to %s.' % (branch, commit))
         exit(ERROR_CODE)
-    if head is not None and head not in git_get_head_sha1():
-        WARN('Unexpected HEAD commit.')
-        exit(0)
     os.chdir(cwd)
-    return folder
+    return worktree
+
+# Git Objects
+# Sources of a commit can be read without checking it out: the tree is
+# listed once by "git ls-tree" and blobs are streamed through a single
+# "git cat-file --batch" process.
+GIT_SYMLINK_MODE = '120000'
+
+source_tree = None  # GitTree if reading from git objects
+
+class GitTree(object):
+    def __init__(self, revision):
+        self.revision = revision
+        self.blobs = {}  # {path: (blob id, size)}
+        self.process = None
+        self.pid = None
+        result = subprocess.check_output([GIT_EXECUTABLE, 'ls-tree', '-r', '-l', '-z', revision])
+        for entry in result.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            mode, kind, blob, size = info.split()
+            if kind != 'blob' or mode == GIT_SYMLINK_MODE:
+                DEBUG('"%s" skipped: not a regular file.' % path)
+                continue
+            self.blobs[path] = (blob, int(size))
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.blobs
+
+    def blob(self, path):
+        return self.blobs[os.path.normpath(path)][0]
+
+    def stat(self, path):
+        # Blob ids take the place of modification time
+        blob, size = self.blobs[os.path.normpath(path)]
+        return [size, blob]
+
+    def find(self, name):
+        # Paths of file "name" or of all files under directory "name"
+        name = os.path.normpath(name)
+        return [x for x in self.blobs if x == name or x.startswith(name + '/')]
+
+    def read(self, path):
+        # Pipes must not be shared with forked workers
+        if self.process is None or self.pid != os.getpid():
+            self.process = subprocess.Popen(
+                [GIT_EXECUTABLE, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.pid = os.getpid()
+        self.process.stdin.write(self.blob(path) + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise IOError('Failed to read "%s" from git objects: %s' % (path, ' '.join(header)))
+        content = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # Trailing LF
+        return content
+
+def read_source(path):
+    if source_tree is not None:
+        return source_tree.read(path)
+    with open(path, 'r') as reader:
+        return reader.read()
+
+def source_exists(path):
+    if source_tree is not None:
+        return path in source_tree
+    if directory_index is not None:
+        # Paths are usually joined to a scanned dirname and need no normpath()
+        dirname, name = os.path.split(path)
+        if dirname not in directory_index:
+            dirname, name = os.path.split(os.path.normpath(path))
+            dirname = dirname or os.curdir
+        if dirname in directory_index:
+            return name in directory_index[dirname]
+    return os.path.isfile(path)
 
 # Python Markdown
-import markdown, re
-import markdown.extensions.codehilite
-from markdown import Extension
-from markdown.inlinepatterns import \
-    LinkPattern, ReferencePattern, AutolinkPattern, AutomailPattern, \
-    LINK_RE, REFERENCE_RE, SHORT_REF_RE, AUTOLINK_RE, AUTOMAIL_RE
-from markdown.inlinepatterns import SimpleTagPattern
-from markdown.postprocessors import Postprocessor
-
-# LaTeX Extension
-# oh-my-acm.latex
-class MathJaxPattern(markdown.inlinepatterns.Pattern):
-    def __init__(self):
-        markdown.inlinepatterns.Pattern.__init__(
-            self,
-            r'(?<!\\)(\$\$?)(.+?)\2'
-        )
-
-    def handleMatch(self, m):
-        node = markdown.util.etree.Element('tex')
-        node.text = markdown.util.AtomicString(
-            m.group(2) + m.group(3) + m.group(2))
-        return node
-
-class MathJaxExtension(markdown.Extension):
-    def extendMarkdown(self, md, md_globals):
-        md.inlinePatterns.add('tex', MathJaxPattern(), '<escape')
-
-def markdown_latex(configs=[]):
-    return MathJaxExtension(configs)
-
-# Tasklist Extension
-# oh-my-acm.tasklist
-class ChecklistExtension(Extension):
-    def extendMarkdown(self, md, md_globals):
-        md.postprocessors.add('checklist', ChecklistPostprocessor(md),
-                              '>raw_html')
-
-class ChecklistPostprocessor(Postprocessor):
-    pattern = re.compile(r'<li>\[([ Xx])\]')
-
-    def run(self, html):
-        html = re.sub(self.pattern, self._convert_checkbox, html)
-        before = '<ul>\n<li><input type="checkbox"'
-        after = before.replace('<ul>', '<ul class="checklist">')
-        return html.replace(before, after)
-
-    def _convert_checkbox(self, match):
-        state = match.group(1)
-        checked = ' checked' if state != ' ' else ''
-        return '<li><input type="checkbox" disabled%s>' % checked
-
-def markdown_tasklist(configs=None):
-    if configs is None:
-        return ChecklistExtension()
-    else:
-        return ChecklistExtension(configs=configs)
-
-# DelIns Extension
-# oh-my-acm.delins
-class DelInsExtension(markdown.extensions.Extension):
-    def extendMarkdown(self, md, md_globals):
-        DEL_RE = r"(\~\~)(.+?)(\~\~)"
-        INS_RE = r"(\+\+)(.+?)(\+\+)"
-        md.inlinePatterns.add(
-            'del', SimpleTagPattern(DEL_RE, 'del'), '<not_strong')
-        md.inlinePatterns.add(
-            'ins', SimpleTagPattern(INS_RE, 'ins'), '<not_strong')
-
-def markdown_delins(configs={}):
-    return DelInsExtension(configs=dict(configs))
-
-# Initialize Markdown & C++ Parser according to preferences
+# Python Markdown, its extensions and libclang are loaded on the first
+# document missing the cache: a build served from the cache only reads the
+# cache. load_markdown() publishes the module and the oh-my-acm extensions.
+markdown = None
 md = None
+
+def load_markdown():
+    global markdown
+    global markdown_latex
+    global markdown_tasklist
+    global markdown_delins
+
+    if markdown is not None:
+        return
+    import markdown
+    import markdown.extensions.codehilite
+    from markdown import Extension
+    from markdown.inlinepatterns import SimpleTagPattern
+    from markdown.postprocessors import Postprocessor
+
+    # LaTeX Extension
+    # oh-my-acm.latex
+    class MathJaxPattern(markdown.inlinepatterns.Pattern):
+        def __init__(self):
+            markdown.inlinepatterns.Pattern.__init__(
+                self,
+                r'(?<!\\)(\$\$?)(.+?)\2'
+            )
+
+        def handleMatch(self, m):
+            node = markdown.util.etree.Element('tex')
+            node.text = markdown.util.AtomicString(
+                m.group(2) + m.group(3) + m.group(2))
+            return node
+
+    class MathJaxExtension(markdown.Extension):
+        def extendMarkdown(self, md, md_globals):
+            md.inlinePatterns.add('tex', MathJaxPattern(), '<escape')
+
+    def markdown_latex(configs=[]):
+        return MathJaxExtension(configs)
+
+    # Tasklist Extension
+    # oh-my-acm.tasklist
+    class ChecklistExtension(Extension):
+        def extendMarkdown(self, md, md_globals):
+            md.postprocessors.add('checklist', ChecklistPostprocessor(md),
+                                  '>raw_html')
+
+    class ChecklistPostprocessor(Postprocessor):
+        pattern = re.compile(r'<li>\[([ Xx])\]')
+
+        def run(self, html):
+            html = re.sub(self.pattern, self._convert_checkbox, html)
+            before = '<ul>\n<li><input type="checkbox"'
+            after = before.replace('<ul>', '<ul class="checklist">')
+            return html.replace(before, after)
+
+        def _convert_checkbox(self, match):
+            state = match.group(1)
+            checked = ' checked' if state != ' ' else ''
+            return '<li><input type="checkbox" disabled%s>' % checked
+
+    def markdown_tasklist(configs=None):
+        if configs is None:
+            return ChecklistExtension()
+        else:
+            return ChecklistExtension(configs=configs)
+
+    # DelIns Extension
+    # oh-my-acm.delins
+    class DelInsExtension(markdown.extensions.Extension):
+        def extendMarkdown(self, md, md_globals):
+            DEL_RE = r"(\~\~)(.+?)(\~\~)"
+            INS_RE = r"(\+\+)(.+?)(\+\+)"
+            md.inlinePatterns.add(
+                'del', SimpleTagPattern(DEL_RE, 'del'), '<not_strong')
+            md.inlinePatterns.add(
+                'ins', SimpleTagPattern(INS_RE, 'ins'), '<not_strong')
+
+    def markdown_delins(configs={}):
+        return DelInsExtension(configs=dict(configs))
+
+def markdown_parser():
+    global md
+
+    if md is None:
+        INFO('Loading Python Markdown...')
+        load_markdown()
+        for i in xrange(len(config.MARKDOWN_EXTENSIONS)):
+            ext = config.MARKDOWN_EXTENSIONS[i]
+            if type(ext) == str and ext.startswith('oh-my-acm'):
+                ext = ext.split('.', 1)[1]
+                config.MARKDOWN_EXTENSIONS[i] = eval('markdown_%s()' % ext)
+        md = markdown.Markdown(extensions=config.MARKDOWN_EXTENSIONS)
+    return md
+
+# libclang
+# Searching for libclang runs "locate" and tries every candidate. The
+# library found is remembered in LIBCLANG_STATE_FILE, per user, together
+# with its mtime and version, and loaded directly as long as the candidate
+# settings are the same and the file is unchanged.
+LIBCLANG_STATE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'docmeld', 'libclang.json')
+
 clang = None
 cl = None
-def initialize_parsers():
-    global md
-    global clang
+libclang_source = None  # "state" or "search", for --bench-startup
+
+def libclang_state_key(user_path):
+    return md5(json.dumps([
+        user_path, SYSTEM_LIBCLANG, LIBCLANG_NO_USER_SPECIFIED,
+        LIBCLANG_PRIORITIZE_USER_CONFIG, LIBCLANG_SEARCH_BY_LOCATE
+    ]))
+
+def load_libclang_state(user_path):
+    try:
+        with open(LIBCLANG_STATE_FILE, 'r') as reader:
+            state = json.load(reader)
+        path = state['path']
+        if state['key'] != libclang_state_key(user_path) or \
+           os.path.getmtime(path) != state['mtime']:
+            return None
+    except Exception:
+        return None
+    # A library installed at the preferred user path since the last search
+    if not LIBCLANG_NO_USER_SPECIFIED and LIBCLANG_PRIORITIZE_USER_CONFIG and \
+       path != user_path and os.path.isfile(user_path):
+        return None
+    return state
+
+def save_libclang_state(user_path, path):
+    state = {
+        'key': libclang_state_key(user_path),
+        'path': path,
+        'mtime': os.path.getmtime(path),
+        'version': libclang_version()
+    }
+    try:
+        folder = os.path.dirname(LIBCLANG_STATE_FILE)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        temporary = '%s.%s.tmp' % (LIBCLANG_STATE_FILE, os.getpid())
+        with open(temporary, 'w') as writer:
+            json.dump(state, writer)
+        os.rename(temporary, LIBCLANG_STATE_FILE)
+    except Exception as e:
+        DEBUG('Failed to save "%s". [%s] %s' % (LIBCLANG_STATE_FILE, type(e), e))
+
+def try_libclang(path):
     global cl
-    global SYSTEM_LIBCLANG
 
-    INFO('Loading Python Markdown...')
-    for i in xrange(len(config.MARKDOWN_EXTENSIONS)):
-        ext = config.MARKDOWN_EXTENSIONS[i]
-        if type(ext) == str and ext.startswith('oh-my-acm'):
-            ext = ext.split('.', 1)[1]
-            config.MARKDOWN_EXTENSIONS[i] = eval('markdown_%s()' % ext)
-    md = markdown.Markdown(extensions=config.MARKDOWN_EXTENSIONS)
+    DEBUG('Try loading libclang ("%s")...' % path)
+    try:
+        clang.cindex.Config.set_library_file(path)
+        cl = clang.cindex.Index.create()
+    except:
+        DEBUG('Failed to load "%s".' % path)
+        cl = None
+    return cl is not None
+
+def load_libclang(user_path):
+    # libclang can only be loaded once per process. A build server loads it
+    # before forking, so the jobs simply reuse it.
+    if cl is not None:
+        DEBUG('libclang already loaded.')
+        return
+    last = switch_phase('libclang')
+    try:
+        search_libclang(user_path)
+    finally:
+        switch_phase(last)
+
+def search_libclang(user_path):
+    global clang
+    global libclang_source
 
-    # Clang
+    INFO('Loading C++ Parser...')
     import clang.cindex
+    state = load_libclang_state(user_path)
+    if state is not None and try_libclang(state['path']):
+        INFO('"%s" loaded, as found last time.' % state['path'])
+        libclang_source = 'state'
+        return
+
+    candidates = list(SYSTEM_LIBCLANG)
     if not LIBCLANG_NO_USER_SPECIFIED:
         if LIBCLANG_PRIORITIZE_USER_CONFIG:
-            SYSTEM_LIBCLANG = [config.LIBCLANG_PATH] + SYSTEM_LIBCLANG
+            candidates = [user_path] + candidates
         else:
-            SYSTEM_LIBCLANG.append(config.LIBCLANG_PATH)
+            candidates.append(user_path)
     if LIBCLANG_SEARCH_BY_LOCATE:
         try:
             result = subprocess.check_output(['locate', 'libclang.so']).strip()
-            SYSTEM_LIBCLANG += [x.strip() for x in result.split('\n')]
+            candidates += [x.strip() for x in result.split('\n')]
         except:
             WARN('"locate" found no "libclang.so" file.')
-    DEBUG(SYSTEM_LIBCLANG)
-    for path in SYSTEM_LIBCLANG:
-        if os.path.isfile(path):
-            DEBUG('Try loading libclang ("%s")...' % path)
-            try:
-                clang.cindex.Config.set_library_file(path)
-                cl = clang.cindex.Index.create()
-            except:
-                DEBUG('Failed to load "%s".' % path)
-                cl = None
-            else:
-                INFO('"%s" loaded.' % path)
-                break
+    DEBUG(candidates)
+    for path in candidates:
+        if os.path.isfile(path) and try_libclang(path):
+            INFO('"%s" loaded.' % path)
+            libclang_source = 'search'
+            save_libclang_state(user_path, path)
+            break
     if cl is None:
         ERROR('Failed to load libclang.')
         exit(16)
 
-    INFO('Loading C++ Parser...')
+def initialize_parsers():
+    global highlighter
+
+    # Python Markdown and libclang are loaded on demand, see markdown_parser()
+    # and LibclangHighlighter.tokenize()
+    if highlighter is None:
+        highlighter = create_highlighter(getattr(config, 'HIGHLIGHTER', DEFAULT_HIGHLIGHTER))
     config.SPECIAL_MAP = {}
     for key, li in config.SPECIAL.items():
         for value in li:
             config.SPECIAL_MAP[value] = key
+    prepare_renderer()
+
+# Precompiled Header
+PCH_PATH = None
+PCH_MIN_FILES = 2  # headers included by fewer files are not precompiled
+PCH_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*<([^>]+)>', re.M)
+
+def libclang_version():
+    # clang_getClangVersion is not registered by the Python bindings
+    try:
+        getter = clang.cindex.conf.lib.clang_getClangVersion
+        getter.restype = clang.cindex._CXString
+        version = clang.cindex._CXString.from_result(getter())
+    except:
+        version = None
+    library = clang.cindex.conf.get_filename()
+    if os.path.isfile(library):
+        library = '%s@%s' % (library, os.path.getmtime(library))
+    return '%s (%s)' % (version, library)
+
+def pch_rejected(tu):
+    for msg in tu.diagnostics:
+        if msg.severity >= clang.cindex.Diagnostic.Fatal and \
+           ('precompiled' in msg.spelling or 'PCH' in msg.spelling or 'AST file' in msg.spelling):
+            DEBUG(msg.spelling)
+            return True
+    return False
+
+def prepare_pch(sources):
+    global PCH_PATH
+
+    count = defaultdict(int)
+    headers = []
+    for dirname, path in sources:
+        included = PCH_INCLUDE_RE.findall(read_source(path))
+        for header in sorted(set(included), key=included.index):
+            if header not in count:
+                headers.append(header)
+            count[header] += 1
+    headers = [x for x in headers if count[x] >= PCH_MIN_FILES]
+    if len(headers) == 0:
+        DEBUG('No common header to precompile.')
+        return
+
+    load_libclang(config.LIBCLANG_PATH)
+    key = md5(json.dumps([__VERSION__, config.CLANG_ARGS, headers, libclang_version()]))
+    if not os.path.exists(config.CACHE_DIRECTORY):
+        os.makedirs(config.CACHE_DIRECTORY)
+    path = os.path.abspath(os.path.join(config.CACHE_DIRECTORY, 'pch-%s' % key))
+    if os.path.isfile(path) and os.path.isfile(path + '.hpp') and not DISABLE_CACHE:
+        DEBUG('Precompiled header "%s" reused.' % path)
+        # Only the PCH: clang rejects it if the prelude has a new mtime
+        os.utime(path, None)
+        PCH_PATH = path
+        return
+    # Precompiling failed before with the same headers, settings and libclang
+    failed = path + '.failed'
+    if os.path.isfile(failed) and not DISABLE_CACHE:
+        DEBUG('Precompiling "%s" failed last time. Skipped.' % path)
+        os.utime(failed, None)
+        return
+
+    INFO('Precompiling headers: %s...' % ', '.join(headers))
+    # The prelude stays on disk: clang validates it when loading the PCH.
+    prelude = path + '.hpp'
+    temporary = '%s.%s.tmp' % (prelude, os.getpid())
+    with open(temporary, 'w') as writer:
+        writer.write(''.join('#include <%s>\n' % x for x in headers))
+    os.rename(temporary, prelude)
+    try:
+        tu = cl.parse(
+            prelude, config.CLANG_ARGS + ['-x', 'c++-header'],
+            options=clang.cindex.TranslationUnit.PARSE_INCOMPLETE
+        )
+        for msg in tu.diagnostics:
+            if msg.severity >= clang.cindex.Diagnostic.Error:
+                raise RuntimeError(msg.spelling)
+        temporary = '%s.%s.tmp' % (path, os.getpid())
+        tu.save(temporary)
+        os.rename(temporary, path)
+    except Exception as e:
+        WARN('Failed to precompile headers. [%s] %s' % (type(e), e))
+        os.remove(prelude)
+        with open(failed, 'w') as writer:
+            writer.write('%s\n' % e)
+        return
+    PCH_PATH = path
+
+# Tokenizer
+# Tokens are stored in parallel arrays instead of one ctypes object per
+# token: kinds are TokenKind values, offsets are byte offsets into `source`
+# (ends are exclusive), lines and columns are 1-based as in libclang.
+TOKEN_PUNCTUATION, TOKEN_KEYWORD, TOKEN_IDENTIFIER, TOKEN_LITERAL, TOKEN_COMMENT = range(5)  # as clang.cindex.TokenKind
+
+TokenArrays = namedtuple(
+    'TokenArrays',
+    ['source', 'kinds', 'starts', 'ends', 'lines', 'columns', 'end_lines', 'end_columns']
+)
+
+def token_spelling(tokens, i):
+    return tokens.source[tokens.starts[i]:tokens.ends[i]].tobytes()
+
+def locate_offsets(content, offsets):
+    line_starts = [0] + [m.end() for m in re.finditer('\n', content)]
+    lines = array('i')
+    columns = array('i')
+    line = 0
+    for offset in offsets:
+        # Offsets are sorted
+        while line + 1 < len(line_starts) and line_starts[line + 1] <= offset:
+            line += 1
+        lines.append(line + 1)
+        columns.append(offset - line_starts[line] + 1)
+    return lines, columns
+
+def tokenize_bulk(tu, path):
+    # libclang hands out CXToken {unsigned int_data[4]; void *ptr_data;} with
+    # int_data = (kind, raw location, length, -). The whole buffer is copied
+    # at once and the fields are read with strides.
+    from ctypes import POINTER, byref, c_uint, cast, sizeof, string_at
+    Token = clang.cindex.Token
+    memory = POINTER(Token)()
+    count = c_uint()
+    clang.cindex.conf.lib.clang_tokenize(tu, tu.cursor.extent, byref(memory), byref(count))
+    count = count.value
+    if count == 0:
+        return array('B'), array('i'), array('i')
+    try:
+        raw = array('I')
+        raw.fromstring(string_at(memory, count * sizeof(Token)))
+        stride = sizeof(Token) // raw.itemsize
+        base = clang.cindex.SourceLocation.from_offset(tu, tu.get_file(path), 0).int_data
+        kinds = array('B', raw[0::stride])
+        starts = array('i', (x - base for x in raw[1::stride]))
+        ends = array('i', (x + y for x, y in zip(starts, raw[2::stride])))
+
+        # Check the layout against the public API before trusting it
+        tokens = cast(memory, POINTER(Token * count)).contents
+        for i in set([0, count - 1]):
+            token = Token()
+            token.int_data = tokens[i].int_data
+            token.ptr_data = tokens[i].ptr_data
+            token._tu = tu
+            extent = token.extent
+            if token.kind.value != kinds[i] or \
+               extent.start.offset != starts[i] or extent.end.offset != ends[i]:
+                return None
+    finally:
+        clang.cindex.conf.lib.clang_disposeTokens(tu, memory, count)
+    return kinds, starts, ends
+
+def tokenize(tu, path, content):
+    result = tokenize_bulk(tu, path)
+    if result is None:
+        DEBUG('Unexpected token layout. Use per-token extraction instead.')
+        kinds, starts, ends = array('B'), array('i'), array('i')
+        for token in tu.get_tokens(extent=tu.cursor.extent):
+            extent = token.extent
+            kinds.append(token.kind.value)
+            starts.append(extent.start.offset)
+            ends.append(extent.end.offset)
+    else:
+        kinds, starts, ends = result
+    lines, columns = locate_offsets(content, starts)
+    end_lines, end_columns = locate_offsets(content, ends)
+    return TokenArrays(memoryview(content), kinds, starts, ends, lines, columns, end_lines, end_columns)
 
 # C++ Parser
-def get_tag(token):
-    NONE = -1
-    NON_ASCII = 1
-    ASCII = 0
-    def get_type(c):
-        if ord(c) > 255:
-            return NON_ASCII
-        return ASCII
-
-    tags = (token.spelling or token.displayname).decode('utf-8').split('\n')
-    for i in xrange(len(tags)):
-        last = NONE
-        ret = []
-        for c in tags[i]:
-            t = get_type(c)
-            if t != last:
-                if t == NON_ASCII:
-                    ret.append(config.TAG_BEGIN.format(name=config.NON_ASCII_CLASS))
-                elif last != NONE:
-                    ret.append(config.TAG_END)
-            if c in config.REPLACEMENT:
-                ret.append(config.REPLACEMENT[c])
+# Rendering
+# Opening tags for every token kind, with or without a SPECIAL class, and
+# the HTML escaping of REPLACEMENT are prepared once per configuration.
+# Characters above U+00FF are wrapped in NON_ASCII_CLASS spans.
+HIGH_BYTE_RE = re.compile(r'[\x80-\xff]')
+NON_ASCII_RE = re.compile(u'([^\x00-\xff]+)')
+
+open_tags = {}  # {(kind, special class or None): opening tag}
+class_aliases = {}  # {class: short alias} in compact mode
+non_ascii_tag = None
+escape_pattern = None
+escape_map = {}
+
+def prepare_renderer():
+    global non_ascii_tag
+    global escape_pattern
+
+    kind_classes = {
+        TOKEN_KEYWORD: config.KEYWORD_CLASS,
+        TOKEN_IDENTIFIER: config.IDENTIFIER_CLASS,
+        TOKEN_COMMENT: config.COMMENT_CLASS,
+        TOKEN_LITERAL: config.LITERAL_CLASS,
+        TOKEN_PUNCTUATION: config.PUNCTUATION_CLASS
+    }
+    class_aliases.clear()
+    if COMPACT_OUTPUT:
+        names = set(kind_classes.values()) | set(config.SPECIAL) | \
+            set([config.NON_ASCII_CLASS, config.LINE_CLASS])
+        for i, name in enumerate(sorted(names)):
+            class_aliases[name] = short_alias(i)
+    def _alias(name):
+        return class_aliases.get(name, name)
+    open_tags.clear()
+    for kind, name in kind_classes.items():
+        open_tags[kind, None] = config.TAG_BEGIN.format(name=_alias(name))
+        for special in set(config.SPECIAL_MAP.values()):
+            open_tags[kind, special] = config.TAG_BEGIN.format(name='%s %s' % (_alias(name), _alias(special)))
+    non_ascii_tag = config.TAG_BEGIN.format(name=_alias(config.NON_ASCII_CLASS))
+    escape_map.clear()
+    for key, value in config.REPLACEMENT.items():
+        if type(key) is str:
+            key = key.decode(config.ENCODING)
+        if type(value) is str:
+            value = value.decode(config.ENCODING)
+        escape_map[key] = value
+    # Longer keys first, as the former character-wise lookup never matched them
+    keys = sorted(escape_map, key=len, reverse=True)
+    escape_pattern = re.compile(u'|'.join(re.escape(x) for x in keys)) if keys else None
+
+def short_alias(index):
+    # "A", "B", ..., "Z", "AA", "AB", ...
+    alias = ''
+    index += 1
+    while index:
+        index, digit = divmod(index - 1, 26)
+        alias = chr(ord('A') + digit) + alias
+    return alias
+
+def _escape_match(m):
+    return escape_map[m.group()]
+
+def escape_html(text):
+    return escape_pattern.sub(_escape_match, text) if escape_pattern is not None else text
+
+def get_tag(spelling):
+    # Escaped lines of a token
+    tags = spelling.decode('utf-8').split('\n')
+    if HIGH_BYTE_RE.search(spelling) is None:
+        return [escape_html(x) for x in tags]
+    result = []
+    for tag in tags:
+        # Runs of non-ASCII characters are at odd indices
+        parts = NON_ASCII_RE.split(tag)
+        for i in xrange(len(parts)):
+            if i % 2:
+                parts[i] = '%s%s%s' % (non_ascii_tag, escape_html(parts[i]), config.TAG_END)
             else:
-                ret.append(c)
-            last = t
-        if last == NON_ASCII:
-            ret.append(config.TAG_END)
-        tags[i] = ''.join(ret)
-
-    return tags
+                parts[i] = escape_html(parts[i])
+        result.append(''.join(parts))
+    return result
 
-def parse_cxx(path, dirname):
+def parse_translation_unit(path, fast=False, content=None):
+    global PCH_PATH
+
+    # Sources read from git objects do not exist on disk
+    unsaved_files = None if content is None else [(path, content)]
+    options = clang.cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    if fast:
+        # Only tokens, the leading comment and the macro definitions of the
+        # main file are used, so headers and semantic analysis can be skipped.
+        options |= LIBCLANG_PARSE_SINGLE_FILE | \
+            clang.cindex.TranslationUnit.PARSE_INCOMPLETE | \
+            clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+    elif PCH_PATH is not None:
+        try:
+            tu = cl.parse(
+                path, config.CLANG_ARGS + ['-include-pch', PCH_PATH],
+                unsaved_files=unsaved_files, options=options
+            )
+        except clang.cindex.TranslationUnitLoadError:
+            tu = None
+        if tu is not None and not pch_rejected(tu):
+            return tu
+        WARN('Precompiled header "%s" rejected. Fall back to normal parsing.' % PCH_PATH)
+        PCH_PATH = None
+    return cl.parse(path, config.CLANG_ARGS, unsaved_files=unsaved_files, options=options)
+
+def report_diagnostics(tu):
     if sys.stderr.isatty():
         SEVERITY_NAME = {
             clang.cindex.Diagnostic.Ignored: 'IGN',
@@ -364,21 +1262,6 @@ def parse_cxx(path, dirname):
             clang.cindex.Diagnostic.Fatal: 'FATAL'
         }
 
-    INFO('Parsing "%s"...' % path)
-    with open(path, 'r') as reader:
-        content = reader.read()
-    cache, flag = load_cache(content, path)
-    if flag:
-        DEBUG('"%s" cached.' % path)
-        with open(cache, 'r') as reader:
-            return pickle.load(reader)
-
-    DEBUG('Options: %s' % ' '.join(config.CLANG_ARGS))
-    lines = content.split('\n')
-    tu = cl.parse(
-        path, config.CLANG_ARGS,
-        options=clang.cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
-    )
     diag = list(tu.diagnostics)
     if len(diag):
         for msg in diag:
@@ -389,59 +1272,210 @@ def parse_cxx(path, dirname):
             ))
         WARN('Diagnostics ignored. Processing will continue.')
 
+# Highlighters
+# A highlighter turns a C++ source into TokenArrays plus the (line, name)
+# definitions of BLOCK_BEGIN_MARCO/BLOCK_END_MARCO, in source order.
+# prepare() is given all C++ sources of the build and those to highlight.
+class LibclangHighlighter(object):
+    def initialize(self):
+        load_libclang(config.LIBCLANG_PATH)
+
+    def prepare(self, sources, highlighted):
+        # The shared headers are counted over all sources, so that the same
+        # PCH serves every build of the tree
+        if highlighted and not FAST_PARSE and getattr(config, 'PRECOMPILED_HEADER', True):
+            prepare_pch(sources)
+
+    def tokenize(self, path, content):
+        self.initialize()
+        DEBUG('Options: %s' % ' '.join(config.CLANG_ARGS))
+        tu = parse_translation_unit(path, fast=FAST_PARSE, content=content)
+        if SHOW_DIAGNOSTICS:
+            report_diagnostics(tu)
+        markers = []
+        for cur in tu.cursor.get_children():
+            if cur.kind == clang.cindex.CursorKind.MACRO_DEFINITION and \
+               cur.spelling in (config.BLOCK_BEGIN_MARCO, config.BLOCK_END_MARCO):
+                markers.append((cur.location.line, cur.spelling))
+        return tokenize(tu, path, content), markers
+
+# Python C++ Lexer
+# Mirrors the raw lexer behind clang_tokenize: every byte of the file is
+# lexed, including preprocessor lines and disabled #if blocks, and
+# everything unknown is punctuation.
+CXX_KEYWORDS = frozenset("""
+    alignas alignof and and_eq asm auto bitand bitor bool break case catch
+    char char16_t char32_t class compl const constexpr const_cast continue
+    decltype default delete do double dynamic_cast else enum explicit export
+    extern false float for friend goto if inline int long mutable namespace
+    new noexcept not not_eq nullptr operator or or_eq private protected
+    public register reinterpret_cast return short signed sizeof static
+    static_assert static_cast struct switch template this thread_local throw
+    true try typedef typeid typename union unsigned using virtual void
+    volatile wchar_t while xor xor_eq
+    _Alignas _Alignof _Atomic _Complex _Generic _Imaginary _Noreturn
+    _Static_assert _Thread_local
+    __alignof __alignof__ __asm __asm__ __attribute __attribute__
+    __builtin_offsetof __builtin_va_arg __const __const__ __decltype
+    __extension__ __func__ __FUNCTION__ __PRETTY_FUNCTION__ __imag __imag__
+    __inline __inline__ __int128 __label__ __null __real __real__
+    __restrict __restrict__ __signed __signed__ __thread __typeof __typeof__
+    __volatile __volatile__
+""".split())
+CXX_PUNCTUATORS = [
+    '%:%:', '>>=', '<<=', '->*', '...',
+    '##', '::', '->', '++', '--', '<<', '>>', '<=', '>=', '==', '!=', '&&',
+    '||', '+=', '-=', '*=', '/=', '%=', '&=', '|=', '^=', '.*', '<:', ':>',
+    '<%', '%>', '%:'
+]
+# Line splices (backslash at the end of a line) are skipped like clang: a
+# token starts at the splices before it, splices inside identifiers and
+# numbers are part of the token, and those followed by whitespace are
+# whitespace.
+CXX_SPLICES = r'(?:\\\r?\n)*'
+CXX_SPLICE_RE = re.compile(r'\\\r?\n')
+CXX_TOKEN_RE = re.compile(CXX_SPLICES + '(?:' + '|'.join([
+    r'(?P<space>[ \t\r\n\v\f](?:[ \t\r\n\v\f]|\\\r?\n(?=[ \t\r\n\v\f]))*|\Z)',
+    r'(?P<comment>//(?:[^\n\\]|\\\r?\n|\\.)*|/\*.*?(?:\*/|\Z))',
+    r'(?P<raw>(?:u8|u|U|L)?R"(?P<delimiter>[^ ()\\\t\v\f\n]{0,16})\(.*?\)(?P=delimiter)"[A-Za-z_0-9]*)',
+    r'(?P<literal>(?:u8|u|U|L)?(?:"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')[A-Za-z_0-9]*'
+        r'|\.?[0-9](?:{0}(?:[eEpP]{0}[+-]|\'{0}[0-9A-Za-z_]|[0-9A-Za-z_.]))*)'.format(CXX_SPLICES),
+    r'(?P<identifier>[A-Za-z_$\x80-\xff](?:{0}[A-Za-z_$0-9\x80-\xff])*)'.format(CXX_SPLICES),
+    # "<::" is "<" "::" unless followed by ":" or ">" (C++11)
+    r'(?P<punctuation><(?=::[^:>])|%s|.)' % '|'.join(re.escape(x) for x in CXX_PUNCTUATORS)
+]) + ')', re.S)
+CXX_TOKEN_KINDS = {
+    'comment': TOKEN_COMMENT,
+    'raw': TOKEN_LITERAL,
+    'literal': TOKEN_LITERAL,
+    'identifier': TOKEN_IDENTIFIER,
+    'punctuation': TOKEN_PUNCTUATION
+}
+
+def lex_cxx(content):
+    kinds, starts, ends = array('B'), array('i'), array('i')
+    match = CXX_TOKEN_RE.match
+    pos = 0
+    while pos < len(content):
+        m = match(content, pos)
+        pos = m.end()
+        if m.lastgroup == 'space':
+            continue
+        kind = CXX_TOKEN_KINDS[m.lastgroup]
+        if kind == TOKEN_IDENTIFIER:
+            spelling = m.group()
+            if '\\' in spelling:
+                spelling = CXX_SPLICE_RE.sub('', spelling)
+            if spelling in CXX_KEYWORDS:
+                kind = TOKEN_KEYWORD
+        kinds.append(kind)
+        starts.append(m.start())
+        ends.append(pos)
+    lines, columns = locate_offsets(content, starts)
+    end_lines, end_columns = locate_offsets(content, ends)
+    return TokenArrays(memoryview(content), kinds, starts, ends, lines, columns, end_lines, end_columns)
+
+def find_markers(tokens):
+    markers = []
+    names = (config.BLOCK_BEGIN_MARCO, config.BLOCK_END_MARCO)
+    for i in xrange(len(tokens.kinds) - 2):
+        # "#" "define" NAME at the beginning of a line
+        if tokens.kinds[i] == TOKEN_PUNCTUATION and (i == 0 or tokens.lines[i - 1] != tokens.lines[i]) and \
+           token_spelling(tokens, i) in ('#', '%:') and token_spelling(tokens, i + 1) == 'define':
+            name = token_spelling(tokens, i + 2)
+            if name in names:
+                markers.append((tokens.lines[i + 2], name))
+    return markers
+
+class PythonHighlighter(object):
+    def initialize(self):
+        pass
+
+    def prepare(self, sources, highlighted):
+        pass
+
+    def tokenize(self, path, content):
+        tokens = lex_cxx(content)
+        return tokens, find_markers(tokens)
+
+HIGHLIGHTERS = {
+    'libclang': LibclangHighlighter,
+    'python': PythonHighlighter
+}
+DEFAULT_HIGHLIGHTER = 'libclang'
+
+highlighter = None
+def create_highlighter(name):
+    if name not in HIGHLIGHTERS:
+        ERROR('Unknown highlighter "%s". Available: %s.' % (name, ', '.join(sorted(HIGHLIGHTERS))))
+        exit(1)
+    DEBUG('Using highlighter "%s".' % name)
+    return HIGHLIGHTERS[name]()
+
+def parse_cxx(path, dirname):
+    INFO('Parsing "%s"...' % path)
+    cache, flag, result = load_cache(path)
+    if flag:
+        DEBUG('"%s" cached.' % path)
+        return result
+
+    result = render_cxx(path, dirname, read_source(path))
+    write_cache(cache, result)
+    return result
+
+def render_cxx(path, dirname, content):
+    lines = content.split('\n')
+    tokens, markers = highlighter.tokenize(path, content)
+
     DEBUG('Generating HTML...')
     line, column = 1, 1
     buf = []
-    for token in tu.get_tokens(extent=tu.cursor.extent):
-        loc = token.location
-        while loc.line != line:
+    rendered = {}  # {(kind, spelling): (opening tag, inner HTML)}
+    last_tag, last_end = None, 0  # Opening tag of the last span and len(buf) after it
+    for kind, start, end, token_line, token_column, end_line, end_column in itertools.izip(
+            tokens.kinds, tokens.starts, tokens.ends, tokens.lines, tokens.columns,
+            tokens.end_lines, tokens.end_columns):
+        while token_line != line:
             # Sometimes clang will ignore line breaks "\" at the end of each line
             # trailing spaces trimmed
             buf.append(lines[line - 1][column - 1:].rstrip() + '\n')
             line += 1
             column = 1
-        if loc.column != column:
-            tab_count = lines[line - 1][column - 1 : loc.column - 1].count('\t')
-            length = loc.column - column
+        if token_column != column:
+            tab_count = lines[line - 1][column - 1 : token_column - 1].count('\t')
+            length = token_column - column
             buf.append(' ' * ((length - tab_count) + tab_count * config.TABSIZE))
-            column = loc.column
-
-        tags = get_tag(token)
-        #DEBUG(tags)
-        classes = []
-        if token.kind == clang.cindex.TokenKind.KEYWORD:
-            classes.append(config.KEYWORD_CLASS)
-        if token.kind == clang.cindex.TokenKind.IDENTIFIER:
-            classes.append(config.IDENTIFIER_CLASS)
-        if token.kind == clang.cindex.TokenKind.COMMENT:
-            classes.append(config.COMMENT_CLASS)
-        if token.kind == clang.cindex.TokenKind.LITERAL:
-            classes.append(config.LITERAL_CLASS)
-        if token.kind == clang.cindex.TokenKind.PUNCTUATION:
-            classes.append(config.PUNCTUATION_CLASS)
-        if len(tags) == 1 and tags[0] in config.SPECIAL_MAP:
-            classes.append(config.SPECIAL_MAP[tags[0]])
-
-        for i in xrange(len(tags)):
-            tags[i] = '%s%s%s' % (
-                config.TAG_BEGIN.format(name=' '.join(classes)),
-                tags[i], config.TAG_END
-            )
-        buf.append('\n'.join(tags))
 
-        line = token.extent.end.line
-        column = token.extent.end.column
+        key = (kind, content[start:end])
+        if key not in rendered:
+            tags = get_tag(key[1])
+            special = config.SPECIAL_MAP.get(tags[0]) if len(tags) == 1 else None
+            tag = open_tags[kind, special]
+            # Multi-line tokens are split into one span per line
+            rendered[key] = (tag, ('%s\n%s' % (config.TAG_END, tag)).join(tags))
+        tag, html = rendered[key]
+
+        # Adjacent tokens of the same classes share one span
+        if last_tag == tag and last_end == len(buf):
+            buf.pop()
+        else:
+            buf.append(tag)
+        buf.append(html)
+        buf.append(config.TAG_END)
+        last_tag, last_end = tag, len(buf)
+
+        line = end_line
+        column = end_column
     # Includes tailing contents
     if column != len(lines[line - 1]):
         buf.append(lines[line - 1][column - 1:].rstrip())
 
     DEBUG('Parsing metainfo...')
-    data = list(itertools.islice(tu.get_tokens(extent=tu.cursor.extent), 1))[0]
     meta = {}
     meta_end = 1
-    if data.kind == clang.cindex.TokenKind.COMMENT and data.spelling.startswith('/**'):
-        meta_end = data.extent.end.line + 1
-        data = data.spelling.split('\n')[1:-1]
+    if tokens.kinds[0] == TOKEN_COMMENT and token_spelling(tokens, 0).startswith('/**'):
+        meta_end = tokens.end_lines[0] + 1
+        data = token_spelling(tokens, 0).split('\n')[1:-1]
         for row in data:
             key, value = row.split(':', 1)
             key = key.strip('\* ')
@@ -453,38 +1487,22 @@ def parse_cxx(path, dirname):
     for key, val in zip(config.NAMEMETA_KEYS, vals):
         if key not in meta:
             meta[key] = val.strip().decode(config.ENCODING)
-    # Default to match title with description file
-    if config.META_DESCRIPTION not in meta:
-        title = meta[config.META_TITLE]
-        for ext in config.DESCRIPTION_EXTENSIONS:
-            desc = title + ext
-            desc_path = os.path.join(dirname, desc)
-            DEBUG('Try "%s"...' % desc_path)
-            if os.path.isfile(desc_path):
-                break
-            else:
-                desc = None
-        if desc is not None:
-            DEBUG('Matched "%s".' % desc)
-            meta[config.META_DESCRIPTION] = desc
 
     DEBUG('Generating slices...')
     last = 0
     slices = []
-    for cur in tu.cursor.get_children():
-        pos = cur.location.line
-        if cur.kind == clang.cindex.CursorKind.MACRO_DEFINITION:
-            if cur.spelling == config.BLOCK_BEGIN_MARCO:
-                if last:
-                    WARN('[L%s] Duplicated block beginning. Ignored.' % pos)
-                else:
-                    last = pos + 1
-            elif cur.spelling == config.BLOCK_END_MARCO:
-                if last:
-                    slices.append((last, pos))
-                    last = 0
-                else:
-                    WARN('[L%s] Unmatched block ending. Ignored.' % pos)
+    for pos, name in markers:
+        if name == config.BLOCK_BEGIN_MARCO:
+            if last:
+                WARN('[L%s] Duplicated block beginning. Ignored.' % pos)
+            else:
+                last = pos + 1
+        elif name == config.BLOCK_END_MARCO:
+            if last:
+                slices.append((last, pos))
+                last = 0
+            else:
+                WARN('[L%s] Unmatched block ending. Ignored.' % pos)
     if last:
         WARN('[L%s] Unmatched block beginning. Default to file end [L%s].' % (last, line))
         slices.append((last, line + 1))
@@ -492,42 +1510,187 @@ def parse_cxx(path, dirname):
         DEBUG('No specific range. Default is the entire file.')
         slices = [(meta_end, line + 1)]
 
-    result = (''.join(buf), meta, slices)
-    with open(cache, 'w') as writer:
-        pickle.dump(result, writer)
-    return result
+    return (''.join(buf), meta, slices)
 
 def add_line_numbers(s, slices):
-    data = ['<div class="%s"><div class="%s">%%s</div><div class="%s">%s</div></div>' %
-        (config.LINE_CLASS, config.LINE_NUMBER_CLASS, config.CODE_CLASS, code.replace('%', '%%'))
-        for code in s.split('\n')]
+    # Only lines inside slices are generated
+    lines = s.split('\n')
     output = []
+    if COMPACT_OUTPUT:
+        # Numbered by the CSS counter of compact_style()
+        begin = '<div class="%s">' % class_aliases[config.LINE_CLASS]
+        for l, r in slices:
+            for i in xrange(l - 1, r - 1):
+                output.append('%s%s</div>' % (begin, lines[i]))
+        return ('<div class="%s">' % config.CODE_BLOCK_CLASS) + ''.join(output) + '</div>'
+
+    template = '<div class="%s"><div class="%s">%%s</div><div class="%s">%%s</div></div>' % (
+        config.LINE_CLASS, config.LINE_NUMBER_CLASS, config.CODE_CLASS)
     line = 0
     for l, r in slices:
         for i in xrange(l - 1, r - 1):
             line += 1
-            output.append(data[i] % line)
+            output.append(template % (line, lines[i]))
 
     return ('<div class="%s">' % config.CODE_BLOCK_CLASS) + '\n'.join(output) + '</div>'
 
+# Compact Output
+# Lines are numbered by a CSS counter instead of a number element, and
+# token classes are replaced by short aliases. Stylesheets in ASSETS are
+# left as they are: rules that select the renamed classes are copied with
+# the aliases into a <style> element of the page.
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_GROUP_RULES = ('@media', '@supports', '@document', '@layer')
+CSS_COUNTER = 'docmeld-line'
+
+def compact_selector(selector):
+    line = '.' + class_aliases[config.LINE_CLASS]
+    def _class(name):
+        return r'\.%s(?![\w-])' % re.escape(name)
+    # The number and the code of a line are both the line element now
+    for name, replacement in [(config.LINE_NUMBER_CLASS, line + '::before'), (config.CODE_CLASS, line)]:
+        selector = re.sub(r'%s\s*>?\s*%s' % (_class(config.LINE_CLASS), _class(name)), replacement, selector)
+        selector = re.sub(_class(name), replacement, selector)
+    for name, alias in class_aliases.items():
+        selector = re.sub(_class(name), '.' + alias, selector)
+    return selector
+
+def compact_stylesheet(css):
+    # Rewritten rules that select any renamed class, within their @media etc.
+    css = CSS_COMMENT_RE.sub('', css)
+    output = []
+    position = 0
+    while True:
+        begin = css.find('{', position)
+        end = css.find('}', position)
+        if end < 0:
+            break
+        if begin < 0 or end < begin:
+            output.append('}')  # End of a group rule
+            position = end + 1
+            continue
+        # Statements such as @import end with ";"
+        prelude = css[position:begin].rsplit(';', 1)[-1].strip()
+        if prelude.startswith(CSS_GROUP_RULES):
+            output.append(prelude + '{')
+            position = begin + 1
+            continue
+        selector = compact_selector(prelude)
+        if selector != prelude:
+            output.append('%s{%s}' % (selector, css[begin + 1:end].strip()))
+        position = end + 1
+    result = ''.join(output)
+    # Group rules left empty
+    while True:
+        reduced = re.sub(r'@[^{}]*\{\}', '', result)
+        if reduced == result:
+            return result
+        result = reduced
+
+def compact_style():
+    line = class_aliases[config.LINE_CLASS]
+    rules = [
+        '.%s{counter-reset:%s}' % (config.CODE_BLOCK_CLASS, CSS_COUNTER),
+        '.%s{counter-increment:%s}' % (line, CSS_COUNTER),
+        '.%s::before{content:counter(%s)}' % (line, CSS_COUNTER)
+    ]
+    for name in config.ASSETS:
+        paths = source_tree.find(name) if source_tree is not None else \
+            [name] if os.path.isfile(name) else \
+            [os.path.join(dirpath, x) for dirpath, _, fnames in os.walk(name) for x in fnames]
+        for path in sorted(paths):
+            if path.endswith('.css'):
+                rules.append(compact_stylesheet(read_source(path).decode(config.ENCODING)))
+    return u'<style>%s</style>' % ''.join(rules)
+
 # Markdown Parser
 def parse_markdown(path, dirname):
     DEBUG('Parsing markdown file: %s' % path)
-    with open(path, 'r') as reader:
-        content = reader.read()
-    cache, flag = load_cache(content, path)
+    start = time.time()
+    cache, flag, result = load_cache(path)
     if flag:
         DEBUG('"%s" cached.' % path)
-        with open(cache, 'r') as reader:
-            return pickle.load(reader)
-    result = md.convert(content.decode(config.ENCODING))
-    with open(cache, 'w') as writer:
-        pickle.dump(result, writer)
+        record_parse(path, 'markdown', time.time() - start, True)
+        return result
+    result = markdown_parser().convert(read_source(path).decode(config.ENCODING))
+    write_cache(cache, result)
+    record_parse(path, 'markdown', time.time() - start, False)
     return result
 
+# Parallel parsing
+def initialize_worker():
+    initialize_parsers()
+
+def parse_cxx_worker(task):
+    # Cache lookups and parse times are counted by the parent
+    dirname, path = task
+    hits = cache_hits
+    start = time.time()
+    result = parse_cxx(path, dirname)
+    return (result, cache_hits > hits, time.time() - start)
+
+def parse_cxx_parallel(tasks, jobs):
+    global cache_hits
+    global cache_misses
+
+    # Each worker initializes its parsers once. libclang is either loaded
+    # by the worker itself or inherited if the parent has loaded it already.
+    pool = multiprocessing.Pool(jobs, initializer=initialize_worker)
+    try:
+        # map() keeps the order of tasks, so the output stays identical
+        # to the serial build.
+        results = pool.map(parse_cxx_worker, tasks, chunksize=1)
+    except BaseException:
+        # Queued parses are dropped, e.g. on a worker error or BuildTimeout
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    for (_, path), (_, hit, seconds) in zip(tasks, results):
+        if hit:
+            cache_hits += 1
+        else:
+            cache_misses += 1
+        record_parse(path, 'cxx', seconds, hit)
+    return [result for result, _, _ in results]
+
 # Resolver
-def resolve(path, dirname):
-    code, meta, slices = parse_cxx(path, dirname)
+Item = namedtuple(
+    'Item', ['desc', 'desc_path', 'code', 'title', 'category', 'rank', 'path', 'meta']
+)
+# What the table of contents needs. The HTML of a document stays in the
+# cache until it is written out.
+Entry = namedtuple(
+    'Entry', ['key', 'title', 'category', 'rank', 'path', 'desc_path']
+)
+
+def resolve(path, dirname, parsed=None):
+    if parsed is None:
+        last = switch_phase('parse')
+        hits = cache_hits
+        start = time.time()
+        parsed = parse_cxx(path, dirname)
+        record_parse(path, 'cxx', time.time() - start, cache_hits > hits)
+        switch_phase(last)
+    code, meta, slices = parsed
+
+    # Default to match title with description file. Which files exist is not
+    # part of the cache key, so this is not done by parse_cxx().
+    if config.META_DESCRIPTION not in meta:
+        title = meta[config.META_TITLE]
+        for ext in config.DESCRIPTION_EXTENSIONS:
+            desc = title + ext
+            desc_path = os.path.join(dirname, desc)
+            DEBUG('Try "%s"...' % desc_path)
+            if source_exists(desc_path):
+                break
+            else:
+                desc = None
+        if desc is not None:
+            DEBUG('Matched "%s".' % desc)
+            meta = dict(meta)
+            meta[config.META_DESCRIPTION] = desc
 
     DEBUG('Metainfo:')
     for item in meta.items():
@@ -540,44 +1703,549 @@ def resolve(path, dirname):
     title = meta[config.META_TITLE] if config.META_TITLE in meta else config.META_DEFAULT_TITLE
     category = meta[config.META_CATEGORY] if config.META_CATEGORY in meta else config.META_DEFAULT_CATEGORY
     rank = int(meta[config.META_RANK]) if config.META_RANK in meta else config.META_DEFAULT_RANK
-    return namedtuple(
-        'Item', ['desc', 'desc_path', 'code', 'title', 'category', 'rank', 'path', 'meta']
-    )(desc, desc_path, code, title, category, rank, path, meta)
+    return Item(desc, desc_path, code, title, category, rank, path, meta)
+
+def load_document(entry):
+    # Reused entries are counted as cache hits by main()
+    flag, fields = fetch_cache(entry.key, count=False)
+    if flag:
+        return Item(*fields)
+    # Evicted by another build sharing the cache
+    DEBUG('"%s" is not in the cache any more.' % entry.path)
+    return resolve(entry.path, os.path.dirname(entry.path) or os.curdir)
+
+# Streaming Output
+# The page is written piece by piece into a temporary file, which is then
+# renamed over the output: readers never see a partial page.
+TEMPLATE_MARKER = u'\0document\0'
+
+def split_template(template, **kwargs):
+    # Text before and after "{document}"
+    head, _, tail = template.format(document=TEMPLATE_MARKER, **kwargs).partition(TEMPLATE_MARKER)
+    return head, tail
+
+def join_lines(pieces):
+    # '\n'.join(), lazily
+    first = True
+    for piece in pieces:
+        if not first:
+            yield '\n'
+        first = False
+        yield piece
+
+def write_atomic(path, pieces):
+    # Returns the MD5 of the content
+    temporary = '%s.%s.tmp' % (path, os.getpid())
+    checksum = hashlib.md5()
+    try:
+        with open(temporary, 'wb') as writer:
+            for piece in pieces:
+                if isinstance(piece, basestring):
+                    piece = [piece]
+                for text in piece:
+                    data = text.encode(config.ENCODING)
+                    checksum.update(data)
+                    writer.write(data)
+        os.rename(temporary, path)
+    except:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return checksum.hexdigest()
+
+# Split Output
+# With "--split", the output page only holds the table of contents and a
+# placeholder per category. The documents of a category are written into
+# "<output>-fragments/<md5(category)>.<md5(content)>.html", which can be
+# cached forever, and loaded when the placeholder is scrolled into view or
+# a document in it is navigated to. A "docmeld-fragment" event is fired on
+# the placeholder once it is filled.
+FRAGMENT_FOLDER_SUFFIX = '-fragments'
+FRAGMENT_HASH_LENGTH = 12
+FRAGMENT_PLACEHOLDER = u'<div class="docmeld-fragment" data-src="{url}" data-first="{first}" data-last="{last}" style="min-height: 100vh"></div>'
+FRAGMENT_LOADER = u'''<script>(function () {
+  var parts = document.querySelectorAll('.docmeld-fragment');
+  function load(part, done) {
+    if (part.loaded) return done && done();
+    (part.waiting = part.waiting || []).push(done);
+    if (part.waiting.length > 1) return;
+    var request = new XMLHttpRequest();
+    request.open('GET', part.getAttribute('data-src'));
+    request.onload = function () {
+      part.innerHTML = request.responseText;
+      part.style.minHeight = '';
+      part.loaded = true;
+      var event = document.createEvent('Event');
+      event.initEvent('docmeld-fragment', true, false);
+      part.dispatchEvent(event);
+      part.waiting.forEach(function (f) { f && f(); });
+    };
+    request.send();
+  }
+  function navigate() {
+    var id = decodeURIComponent(location.hash.slice(1));
+    if (!id || document.getElementById(id)) return;
+    for (var i = 0; i < parts.length; i++) {
+      var first = +parts[i].getAttribute('data-first'), last = +parts[i].getAttribute('data-last');
+      if (first <= +id && +id <= last) return load(parts[i], function () {
+        var target = document.getElementById(id);
+        if (target) target.scrollIntoView();
+      });
+    }
+  }
+  window.addEventListener('hashchange', navigate);
+  navigate();
+  if (!window.IntersectionObserver) {
+    for (var i = 0; i < parts.length; i++) load(parts[i]);
+    return;
+  }
+  var observer = new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting) {
+        observer.unobserve(entry.target);
+        load(entry.target);
+      }
+    });
+  }, {rootMargin: '100%'});
+  for (var i = 0; i < parts.length; i++) observer.observe(parts[i]);
+})();</script>'''
+
+def fragment_folder(output_path):
+    return os.path.splitext(output_path)[0] + FRAGMENT_FOLDER_SUFFIX
+
+def write_fragment(folder, prefix, pieces):
+    staging = os.path.join(folder, prefix + '.html')
+    digest = write_atomic(staging, join_lines(pieces))
+    name = '%s.%s.html' % (prefix, digest[:FRAGMENT_HASH_LENGTH])
+    os.rename(staging, os.path.join(folder, name))
+    return name
+
+def fragment_placeholder(folder, name, first='', last=''):
+    url = '%s/%s' % (urllib.quote(os.path.basename(folder)), name)
+    return FRAGMENT_PLACEHOLDER.format(url=url, first=first, last=last)
+
+def remove_stale_fragments(folder, fragments):
+    for name in os.listdir(folder):
+        if name.endswith('.html') and name not in fragments:
+            DEBUG('Remove fragment "%s"...' % name)
+            os.remove(os.path.join(folder, name))
+
+# Build server
+BUILD_SERVER_PRELOAD = 'default_preferences'
+BUILD_TIMEOUT_CODE = 124
+# Anyone who can connect may start builds: only the owner by default. Both
+# the build server and uWSGI run as the same user.
+BUILD_SERVER_SOCKET_MODE = 0o600
+
+class BuildTimeout(Exception):
+    pass
+
+class BuildServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    pass
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    # Runs in a process forked for this connection: the job gets its own
+    # config module, working directory and globals, while libclang and the
+    # Markdown modules loaded by the server are inherited warm.
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError:
+            ERROR('Malformed build job.')
+            return
+        returncode = run_build_job(job)
+        self.wfile.write(json.dumps({'returncode': returncode}) + '\n')
+
+def run_build_job(job):
+    def _timeout(signum, frame):
+        raise BuildTimeout()
+
+    log = open(job['log'], 'a') if job.get('log') else open(os.devnull, 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    if job.get('timeout'):
+        signal.signal(signal.SIGALRM, _timeout)
+        signal.alarm(int(job['timeout']))
+    try:
+        os.chdir(job['cwd'])
+        main([x.encode('utf-8') for x in job['argv']])
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if type(e.code) is int else 1
+    except BuildTimeout:
+        ERROR('Time limit exceeded (%ss).' % job['timeout'])
+        return BUILD_TIMEOUT_CODE
+    except Exception as e:
+        ERROR('An error occurred during the build. [%s] %s' % (type(e), e))
+        return 1
+    finally:
+        signal.alarm(0)
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def warm_up():
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        preload = importlib.import_module(BUILD_SERVER_PRELOAD)
+    except ImportError:
+        WARN('"%s" not found. Nothing to preload.' % BUILD_SERVER_PRELOAD)
+        return
+    INFO('Preloading Markdown extensions...')
+    load_markdown()
+    for ext in preload.MARKDOWN_EXTENSIONS:
+        if type(ext) == str and not ext.startswith('oh-my-acm'):
+            try:
+                importlib.import_module(ext)
+            except ImportError:
+                WARN('Failed to preload "%s".' % ext)
+    try:
+        load_libclang(preload.LIBCLANG_PATH)
+    except SystemExit:
+        WARN('libclang not preloaded. Only the "python" highlighter will be warm.')
+
+def serve(address):
+    warm_up()
+    if os.path.exists(address):
+        os.remove(address)
+    # The socket is created by bind() with the umask in effect
+    umask = os.umask(0o777 & ~BUILD_SERVER_SOCKET_MODE)
+    try:
+        server = BuildServer(address, BuildRequestHandler)
+    finally:
+        os.umask(umask)
+    os.chmod(address, BUILD_SERVER_SOCKET_MODE)
+    INFO('Build server listening on "%s"...' % address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(address)
+
+# Cache command
+def cache_main(argv):
+    global FAST_PARSE
+    global COMPACT_OUTPUT
+    global CACHE_FINGERPRINT
+
+    parser = argparse.ArgumentParser(prog='docmeld.py cache', description='Inspect or maintain the cache of a document directory.')
+    parser.add_argument('COMMAND', choices=['stats', 'prune', 'verify'], help='"stats": show cache usage. "prune": evict least recently used entries down to the size limit. "verify": check every entry.')
+    parser.add_argument('LOCATION', nargs='?', default='.', help='path to the root directory of documents (default: current directory).')
+    parser.add_argument('-l', '--limit', type=int, help='size limit in bytes for "prune" (default: CACHE_SIZE_LIMIT in preferences.py).')
+    parser.add_argument('-H', '--highlighter', choices=sorted(HIGHLIGHTERS), help='highlighter used by the builds, for "verify".')
+    parser.add_argument('--fix', action='store_true', help='remove corrupted and stale entries found by "verify".')
+    parser.add_argument('--cache-dir', default=os.environ.get(CACHE_DIRECTORY_ENV), help='shared cache directory instead of CACHE_DIRECTORY in preferences.py (default: $%s).' % CACHE_DIRECTORY_ENV)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.LOCATION):
+        ERROR('Failed to open directory "%s"' % args.LOCATION)
+        exit(1)
+    cache_directory = os.path.abspath(args.cache_dir) if args.cache_dir else None
+    root_directory = os.path.abspath(args.LOCATION)
+    os.chdir(root_directory)
+    load_preferences(root_directory, cache_directory)
+    limit = getattr(config, 'CACHE_SIZE_LIMIT', DEFAULT_CACHE_SIZE_LIMIT)
+
+    if args.COMMAND == 'stats':
+        entries = list_cache()
+        total = sum(size for _, size, _, _ in entries)
+        print('Directory: %s' % os.path.abspath(config.CACHE_DIRECTORY))
+        print('Entries:   %s (%s files)' % (len(entries), sum(1 for x in entries if x[2])))
+        print('Size:      %s bytes (limit: %s bytes, %.1f%%)' % (total, limit, 100.0 * total / limit if limit else 0))
+        if entries:
+            print('Oldest:    %s' % datetime.fromtimestamp(entries[0][0]))
+            print('Newest:    %s' % datetime.fromtimestamp(entries[-1][0]))
+    elif args.COMMAND == 'prune':
+        if args.limit is not None:
+            limit = args.limit
+        removed, total = prune_cache(limit)
+        INFO('%s entries evicted. %s bytes left.' % (removed, total))
+    elif args.COMMAND == 'verify':
+        FAST_PARSE = getattr(config, 'FAST_PARSE', False)
+        COMPACT_OUTPUT = getattr(config, 'COMPACT_OUTPUT', False)
+        CACHE_FINGERPRINT = render_fingerprint(args.highlighter or getattr(config, 'HIGHLIGHTER', DEFAULT_HIGHLIGHTER))
+        connection = open_cache()
+        valid, stale, corrupted = 0, [], []
+        problem = connection.execute('PRAGMA integrity_check').fetchone()[0]
+        if problem != 'ok':
+            ERROR('Cache database integrity check failed: %s' % problem)
+            exit(1)
+        for key, version, fingerprint, value in connection.execute(
+                'SELECT key, version, fingerprint, value FROM entries'):
+            try:
+                pickle.loads(str(value))
+            except Exception as e:
+                DEBUG('"%s": [%s] %s' % (key, type(e), e))
+                corrupted.append((False, key))
+                continue
+            if version == __VERSION__ and fingerprint == CACHE_FINGERPRINT:
+                valid += 1
+            else:
+                stale.append((False, key))
+        # Loose files other than precompiled headers are left over by older versions
+        for _, _, is_file, location in list_cache():
+            if is_file and not os.path.basename(location).startswith('pch-'):
+                stale.append((True, location))
+        INFO('%s valid, %s stale, %s corrupted entries.' % (valid, len(stale), len(corrupted)))
+        if args.fix:
+            connection.execute('BEGIN IMMEDIATE')
+            for is_file, location in stale + corrupted:
+                if is_file:
+                    os.remove(location)
+                else:
+                    connection.execute('DELETE FROM entries WHERE key = ?', (location,))
+            connection.execute('COMMIT')
+            connection.execute('PRAGMA incremental_vacuum')
+            INFO('%s entries removed.' % (len(stale) + len(corrupted)))
+        elif corrupted:
+            exit(1)
+
+# Build Timings
+# main() marks where each phase starts. Sources parsed on demand and
+# libclang, loaded on demand, switch to the "parse" and "libclang" phases
+# and back; time spent in a phase entered again adds up. With "--timings",
+# the wall and CPU time of every phase, the parse time of every file, cache
+# counters and peak RSS are reported at the end; "--profile" runs cProfile during the
+# phases in PROFILED_PHASES (in this process only, not in -j workers).
+PROFILED_PHASES = ('parse', 'resolve', 'write')
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024  # of ru_maxrss
+TIMINGS_SLOWEST_FILES = 10  # listed by "--timings text"
+timings = None  # {'phases': [...], 'files': {...}} if enabled
+profiler = None
+current_phase = None  # (name, wall time, CPU time, CPU time of children)
+
+def cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def enter_phase(name):
+    # Ends the current phase. name=None ends the last one.
+    global current_phase
+
+    if timings is None and profiler is None:
+        return
+    now = (time.time(), cpu_time(resource.RUSAGE_SELF), cpu_time(resource.RUSAGE_CHILDREN))
+    if current_phase is not None:
+        last, wall, cpu, children_cpu = current_phase
+        if profiler is not None and last in PROFILED_PHASES:
+            profiler.disable()
+        if timings is not None:
+            for phase in timings['phases']:
+                if phase['name'] == last:
+                    break
+            else:
+                phase = {'name': last, 'wall': 0, 'cpu': 0, 'children_cpu': 0}
+                timings['phases'].append(phase)
+            phase['wall'] += now[0] - wall
+            phase['cpu'] += now[1] - cpu
+            phase['children_cpu'] += now[2] - children_cpu
+    current_phase = None
+    if name is not None:
+        current_phase = (name,) + now
+        if profiler is not None and name in PROFILED_PHASES:
+            profiler.enable()
+
+def switch_phase(name):
+    # Enters phase `name` and returns the phase it ended, to switch back to
+    last = current_phase[0] if current_phase is not None else None
+    if last != name:
+        enter_phase(name)
+    return last
+
+def record_parse(path, parser, seconds, cached):
+    if timings is None:
+        return
+    if type(path) is not unicode:
+        path = path.decode(config.PATH_ENCODING)
+    timings['files'][path] = {'parser': parser, 'seconds': seconds, 'cached': cached}
+
+def report_timings(format, path, profile_path):
+    enter_phase(None)
+    if profiler is not None:
+        profiler.dump_stats(profile_path)
+        INFO('Profile of %s written to "%s".' % (', '.join(PROFILED_PHASES), profile_path))
+    if timings is None:
+        return
+    timings['total'] = {
+        'wall': sum(x['wall'] for x in timings['phases']),
+        'cpu': sum(x['cpu'] for x in timings['phases']),
+        'children_cpu': sum(x['children_cpu'] for x in timings['phases'])
+    }
+    timings['cache'] = {'hits': cache_hits, 'misses': cache_misses}
+    timings['peak_rss'] = {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT
+    }
+    if format == 'json':
+        with open(path, 'w') as writer:
+            json.dump(timings, writer, indent=2, sort_keys=True)
+        INFO('Timings written to "%s".' % path)
+        return
+    for phase in timings['phases'] + [dict(timings['total'], name='total')]:
+        INFO('%-12s %9.1f ms wall %9.1f ms CPU %9.1f ms children' % (
+            phase['name'], phase['wall'] * 1000, phase['cpu'] * 1000, phase['children_cpu'] * 1000))
+    slowest = sorted(timings['files'].items(), key=lambda x: -x[1]['seconds'])[:TIMINGS_SLOWEST_FILES]
+    for name, record in slowest:
+        INFO('%9.1f ms %s%s' % (record['seconds'] * 1000, name, ' (cached)' if record['cached'] else ''))
+    INFO('Peak RSS: %s KiB, %s KiB in child processes.' % (
+        timings['peak_rss']['self'] // 1024, timings['peak_rss']['children'] // 1024))
+
+# Startup Benchmark
+# --bench-startup times what a build pays before parsing the first document
+# missing the cache: importing docmeld, loading Python Markdown with the
+# preferred extensions and initializing the highlighter. libclang is looked
+# up as in a build, so a second run shows the time saved by
+# LIBCLANG_STATE_FILE.
+def bench_startup(location, highlighter_name):
+    global config
+    global highlighter
+
+    if location is None:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        config = importlib.import_module(BUILD_SERVER_PRELOAD)
+    else:
+        if not os.path.isdir(location):
+            ERROR('Failed to open directory "%s"' % location)
+            exit(1)
+        load_preferences(os.path.abspath(location))
+    highlighter_name = highlighter_name or getattr(config, 'HIGHLIGHTER', DEFAULT_HIGHLIGHTER)
+
+    steps = [('import docmeld', IMPORT_FINISHED - IMPORT_STARTED)]
+    def _measure(name, function):
+        start = time.time()
+        function()
+        steps.append((name, time.time() - start))
+
+    _measure('import markdown', load_markdown)
+    _measure('markdown parser', markdown_parser)
+    highlighter = create_highlighter(highlighter_name)
+    _measure('highlighter "%s"' % highlighter_name, highlighter.initialize)
+    for name, seconds in steps:
+        INFO('%-24s %9.1f ms' % (name, seconds * 1000))
+    INFO('%-24s %9.1f ms' % ('total', sum(x[1] for x in steps) * 1000))
+    if libclang_source == 'state':
+        INFO('libclang "%s" taken from "%s".' % (clang.cindex.conf.get_filename(), LIBCLANG_STATE_FILE))
+    elif libclang_source == 'search':
+        INFO('libclang "%s" searched and saved into "%s".' % (clang.cindex.conf.get_filename(), LIBCLANG_STATE_FILE))
 
 # Main
-def main():
+def load_preferences(root_directory, cache_directory=None):
     global config
+
+    if source_tree is not None:
+        if PREFERENCE_MODULE + '.py' not in source_tree:
+            ERROR('No preference file was found in "%s".' % source_tree.revision)
+            exit(2)
+        config = imp.new_module(PREFERENCE_MODULE)
+        config.__file__ = os.path.join(root_directory, PREFERENCE_MODULE + '.py')
+        exec(compile(read_source(PREFERENCE_MODULE + '.py'), config.__file__, 'exec'), config.__dict__)
+    else:
+        sys.path.append(root_directory)
+        try:
+            config = importlib.import_module(PREFERENCE_MODULE)
+        except ImportError:
+            ERROR('No preference file was found. Please ensure that there is a "preferences.py" in your project directory.')
+            exit(2)
+    if cache_directory:
+        config.CACHE_DIRECTORY = cache_directory
+
+def main(argv=None):
+    global config
+    global CACHE_FINGERPRINT
     global DISABLE_CACHE
     global DISABLE_DEBUG
-
-    parser = argparse.ArgumentParser(description='(docmeld %s) A generic document compiler for ICPC-related contests. Utilized by Fudan U2 in Fall 2019.' % __VERSION__)
-    parser.add_argument('LOCATION', help='path to the root directory of documents or URL to a git repository in "%s<URL>" format.' % GIT_URL_START)
+    global FAST_PARSE
+    global COMPACT_OUTPUT
+    global SPLIT_OUTPUT
+    global SHOW_DIAGNOSTICS
+    global highlighter
+    global source_tree
+    global ignore_pattern
+    global cache_hits
+    global timings
+    global profiler
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['cache']:
+        cache_main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description='(docmeld %s) A generic document compiler for ICPC-related contests. Utilized by Fudan U2 in Fall 2019.' % __VERSION__,
+        epilog='Run "%(prog)s cache -h" for cache maintenance.')
+    parser.add_argument('LOCATION', nargs='?', help='path to the root directory of documents or URL to a git repository in "%s<URL>" format.' % GIT_URL_START)
     parser.add_argument('-o', '--output', help='location to place the generated HTML file.')
     parser.add_argument('-b', '--branch', help='specify the branch of the git repository.')
     parser.add_argument('-c', '--checksum-list', help='examine the checksums of specified files provided by a JSON file for security. JSON format: {"path_to_file": "sha256=...", ...}')
-    parser.add_argument('-s', '--head-sha1', help='examine the SHA1 hash code to current HEAD.')
+    parser.add_argument('-s', '--head-sha1', help='with a git URL, build exactly this commit of the branch.')
+    parser.add_argument('--depth', type=int, help='with a git URL, fetch only the last DEPTH commits.')
+    parser.add_argument('--filter', help='with a git URL, partial clone filter such as "blob:none".')
+    parser.add_argument('-r', '--revision', help='read sources from the git objects of REVISION (e.g. "origin/master") instead of the working tree, which is left untouched. With a git URL, the clone is fetched instead of checked out.')
     parser.add_argument('-n', '--no-cache', action='store_true', help='disable cache and force full re-generation.')
+    parser.add_argument('--cache-dir', default=os.environ.get(CACHE_DIRECTORY_ENV), help='cache directory shared by all builds, instead of CACHE_DIRECTORY in preferences.py (default: $%s).' % CACHE_DIRECTORY_ENV)
+    parser.add_argument('--changed-from', metavar='JSON', help='only rescan the paths listed in JSON since the last build. JSON format: ["path", ...] or {"added": [...], "modified": [...], "removed": [...]}')
+    parser.add_argument('--since', metavar='COMMIT', help='only rescan the paths changed between COMMIT, which must be the last build, and HEAD.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to parse source code (default: 1).')
+    parser.add_argument('-H', '--highlighter', choices=sorted(HIGHLIGHTERS), help='C++ highlighter backend (default: HIGHLIGHTER in preferences.py, or "%s").' % DEFAULT_HIGHLIGHTER)
+    parser.add_argument('--split', action='store_true', help='write an index page and load the documents of each category on demand. Printing needs the single page.')
+    parser.add_argument('--compact', action='store_true', help='smaller HTML: CSS counters for line numbers and short class names.')
+    parser.add_argument('-f', '--fast', action='store_true', help='lex the main file of each source only, without headers and semantic analysis.')
+    parser.add_argument('-d', '--diagnostics', action='store_true', help='show diagnostics reported by clang (implies a full parse).')
     parser.add_argument('-v', '--verbose', action='store_true', help='show more messages.')
     parser.add_argument('-q', '--quiet', action='store_true', help='show less messages.')
-    args = parser.parse_args()
+    parser.add_argument('--timings', choices=['json', 'text'], help='report the time spent in each phase and on each file, cache hits and peak RSS.')
+    parser.add_argument('--timings-file', metavar='PATH', help='where "--timings json" writes (default: next to the output, "<output>.timings.json").')
+    parser.add_argument('--profile', metavar='PATH', help='dump cProfile stats of the %s phases into PATH.' % ', '.join(PROFILED_PHASES))
+    parser.add_argument('--bench-startup', action='store_true', help='report the time spent on importing docmeld and initializing Python Markdown and the highlighter, then exit. LOCATION is optional.')
+    parser.add_argument('--serve', metavar='SOCKET', help='run as a build server listening on the Unix socket SOCKET.')
+    args = parser.parse_args(argv)
 
     if args.no_cache:
         DISABLE_CACHE = True
     if args.verbose:
         DISABLE_DEBUG = False
+    if args.diagnostics:
+        SHOW_DIAGNOSTICS = True
     if args.quiet:
         DISABLE_DEBUG = True
     if args.verbose and args.quiet:
         WARN('Both "-q" and "-v" are enabled. Default to be quiet.')
+    if args.jobs < 1:
+        ERROR('Invalid number of jobs: %s.' % args.jobs)
+        exit(1)
+    if args.bench_startup:
+        bench_startup(args.LOCATION, args.highlighter)
+        return
+    if args.serve:
+        serve(args.serve)
+        return
+    if args.LOCATION is None:
+        parser.error('LOCATION is required.')
     output_path = None
     if args.output:
         output_path = os.path.abspath(args.output)
+    cache_directory = os.path.abspath(args.cache_dir) if args.cache_dir else None
+    if args.timings:
+        timings = {'version': __VERSION__, 'argv': argv, 'phases': [], 'files': {}}
+    if args.profile:
+        profiler = cProfile.Profile()
+        args.profile = os.path.abspath(args.profile)
+    if args.timings_file:
+        args.timings_file = os.path.abspath(args.timings_file)
 
     # Handle URL (local/git)
+    enter_phase('git')
     if args.LOCATION.startswith(GIT_URL_START):
         if args.branch is None:
             args.branch = GIT_DEFAULT_BRANCH
-        root_directory = handle_git_url(args.LOCATION, args.branch, head=args.head_sha1)
+        root_directory = handle_git_url(
+            args.LOCATION, args.branch, head=args.head_sha1, checkout=args.revision is None,
+            depth=args.depth, filter=args.filter
+        )
     else:
         if not os.path.isdir(args.LOCATION):
             ERROR('Failed to open directory "%s"' % args.LOCATION)
@@ -585,6 +2253,7 @@ def main():
         root_directory = args.LOCATION
 
     # Load checksum list (JSON format)
+    enter_phase('preferences')
     checksum_list = {}
     if args.checksum_list is not None:
         if not os.path.exists(args.checksum_list):
@@ -595,109 +2264,277 @@ def main():
 
     root_directory = os.path.abspath(root_directory)
     os.chdir(root_directory)
+    if args.revision is not None:
+        revision = git_rev_parse(args.revision)
+        if revision is None:
+            ERROR('Unknown revision "%s".' % args.revision)
+            exit(8)
+        if args.head_sha1 is not None and args.head_sha1 not in revision:
+            WARN('Unexpected HEAD commit.')
+            exit(0)
+        INFO('Reading sources from commit %s.' % revision)
+        source_tree = GitTree(revision)
     # Examine checksums (especially for preferences.py)
     try:
         for path, sig in checksum_list.items():
-            if not os.path.isfile(path):
+            if not source_exists(path):
                 WARN('File "%s" does not exist. No checksum was examined for this file.' % path)
-            else:
-                with open(path, 'r') as reader:
-                    if not checksum(sig, reader.read()):
-                        ERROR('Decline to compile the project: file "%s" does not pass the checksum examination.' % path)
-                        exit(2333)
+            elif not checksum(sig, read_source(path)):
+                ERROR('Decline to compile the project: file "%s" does not pass the checksum examination.' % path)
+                exit(2333)
     except Exception as e:
         ERROR('An error occurred during checksum examination. [%s] %s' % (type(e), e))
         exit(444)
 
-    # Load preferences
-    sys.path.append(root_directory)
-    try:
-        config = importlib.import_module(PREFERENCE_MODULE)
-    except ImportError:
-        ERROR('No preference file was found. Please ensure that there is a "preferences.py" in your project directory.')
-        exit(2)
+    load_preferences(root_directory, cache_directory)
+
+    if args.fast or getattr(config, 'FAST_PARSE', False):
+        FAST_PARSE = True
+    if FAST_PARSE and SHOW_DIAGNOSTICS:
+        WARN('Diagnostics require a full parse. "--fast" disabled.')
+        FAST_PARSE = False
+    if args.compact or getattr(config, 'COMPACT_OUTPUT', False):
+        COMPACT_OUTPUT = True
+    if args.split or getattr(config, 'SPLIT_OUTPUT', False):
+        SPLIT_OUTPUT = True
+
+    if output_path is None:
+        output_path = os.path.abspath(config.OUTPUT_PATH)
 
     # Compile ignorement rules
-    config.IGNORES = [re.compile(fnmatch.translate(x)) for x in config.IGNORES]
+    ignore_pattern = compile_ignores(config.IGNORES)
+
+    enter_phase('highlighter')
+    highlighter_name = args.highlighter or getattr(config, 'HIGHLIGHTER', DEFAULT_HIGHLIGHTER)
+    highlighter = create_highlighter(highlighter_name)
+    CACHE_FINGERPRINT = render_fingerprint(highlighter_name)
+    if SHOW_DIAGNOSTICS and not isinstance(highlighter, LibclangHighlighter):
+        WARN('Diagnostics are only available with the libclang highlighter.')
+
+    enter_phase('scan')
+    manifest_file = manifest_path(output_path)
+    manifest = {} if DISABLE_CACHE else load_manifest(manifest_file)
+    fingerprint = build_fingerprint()
+    head = source_tree.revision if source_tree is not None else git_rev_parse('HEAD')
+
+    # Changed paths since the last build
+    changes = None
+    if source_tree is not None:
+        pass  # Listing a tree is cheap and blob ids are known
+    elif args.changed_from:
+        changes = load_changes(args.changed_from)
+    elif args.since:
+        since = git_rev_parse(args.since)
+        if since is None or since != manifest.get('head'):
+            WARN('Commit "%s" is not the last build. Scanning all files.' % args.since)
+        else:
+            changes = git_changed_files(args.since)
+    if changes is not None and rebuild_required(manifest, fingerprint, changes):
+        INFO('Settings or assets changed. Scanning all files.')
+        changes = None
 
     # Scan all files
     file_list = []  # (dirname, path, ext)
-    for dirpath, dnames, fnames in os.walk(root_directory, followlinks=True):
-        # Skip hidden files & directories
-        dnames[:] = [x for x in dnames if not x.startswith('.')]
-        fnames[:] = [x for x in fnames if not x.startswith('.')]
-        dirname = os.path.relpath(dirpath, start=root_directory)
-        for name in fnames:
-            path = os.path.relpath(os.path.join(dirpath, name), start=root_directory)
-            if ignored(path):
-                DEBUG('"%s" ignored due to IGNORES list.' % path)
-            else:
-                statinfo = os.stat(path)
-                if statinfo.st_size <= FILESIZE_LIMIT:
-                    _, ext = os.path.splitext(path)
-                    if ext in config.FILE_EXTENSIONS or ext in config.DESCRIPTION_EXTENSIONS:
-                        file_list.append((dirname, path, ext))
-                else:
-                    DEBUG('"%s" ignored due to file size limitation.' % path)
-
+    stats = stat_assets()  # {path: [size, mtime]} of all inputs
+    if source_tree is not None:
+        for path in sorted(source_tree.blobs):
+            # Skip hidden files & directories
+            if any(x.startswith('.') for x in path.split('/')):
+                continue
+            ext = scan_file(path, source_tree.blobs[path][1])
+            if ext is not None:
+                file_list.append((os.path.dirname(path) or os.curdir, path, ext))
+                stats[path.decode(config.PATH_ENCODING)] = source_tree.stat(path)
+    elif changes is None:
+        file_list, scanned = scan_tree()
+        stats.update(scanned)
+    else:
+        INFO('%s path(s) changed since the last build.' % len(changes))
+        # Keep the order of the last scan
+        files = []
+        for name in manifest['files'] + sorted(changes.difference(manifest['files'])):
+            if name not in changes:
+                files.append(name)
+                stats[name] = manifest['inputs'][name][:2]
+                continue
+            path = name.encode(config.PATH_ENCODING)
+            if any(x.startswith('.') for x in name.split(os.sep)) or not os.path.isfile(path):
+                continue
+            statinfo = os.stat(path)
+            if scan_file(path, statinfo.st_size) is not None:
+                files.append(name)
+                stats[name] = [statinfo.st_size, statinfo.st_mtime]
+        for name in files:
+            path = name.encode(config.PATH_ENCODING)
+            _, ext = os.path.splitext(path)
+            file_list.append((os.path.dirname(path) or os.curdir, path, ext))
+
+    # Compare with the last build
+    timings_file = args.timings_file or os.path.splitext(output_path)[0] + '.timings.json'
+    if manifest_up_to_date(manifest, fingerprint, stats, output_path):
+        INFO('Nothing changed since the last build.')
+        report_timings(args.timings, timings_file, args.profile)
+        return
+    previous_inputs = manifest.get('inputs', {})
+    previous_documents = manifest.get('documents', {})
+    inputs = hash_inputs(stats, previous_inputs)
+    # Added or removed files may change which description a source picks
+    changed_folders = set(os.path.dirname(x) for x in set(inputs) ^ set(previous_inputs))
+    documents = {}
+
+    entries = []
+    sources = []
+    for dirname, path, ext in file_list:
+        if ext not in config.FILE_EXTENSIONS:
+            continue
+        name = path.decode(config.PATH_ENCODING)
+        entry = None
+        if name in previous_documents and os.path.dirname(name) not in changed_folders:
+            key, desc_path, title, category, rank = previous_documents[name]
+            if key == document_key(fingerprint, inputs, name, desc_path):
+                DEBUG('"%s" unchanged.' % path)
+                cache_hits += 1
+                entry = Entry(key, title, category, rank, path, desc_path)
+                documents[name] = previous_documents[name]
+        if entry is None:
+            sources.append((dirname, path))
+        entries.append(entry)
+
+    enter_phase('parse')
+    parsed = [None] * len(sources)
+    missing = None
+    if not DISABLE_CACHE:
+        missing = prefetch_cache([path for _, path in sources] +
+            [path for _, path, ext in file_list if ext in config.DESCRIPTION_EXTENSIONS])
+    # Only sources missing the cache are highlighted, and need libclang
+    highlighter.prepare(
+        [(dirname, path) for dirname, path, ext in file_list if ext in config.FILE_EXTENSIONS],
+        [x for x in sources if missing is None or x[1] in missing])
+    if args.jobs > 1 and len(sources) > 1:
+        INFO('Parsing source code with %s processes...' % args.jobs)
+        parsed = parse_cxx_parallel(sources, min(args.jobs, len(sources)))
+
+    enter_phase('initialize')
     initialize_parsers()
+    enter_phase('resolve')
     database = defaultdict(list)
     used_documents = set()
 
     # Process source code
-    for dirname, path, ext in file_list:
-        if ext not in config.FILE_EXTENSIONS:
-            continue
-        result = resolve(path, dirname)
-        if result.desc_path:
-            used_documents.add(result.desc_path)
-        database[result.category].append(result)
-
+    # Resolved documents go to the cache right away, only entries are kept
+    resolved = iter(xrange(len(sources)))
+    for i in xrange(len(entries)):
+        if entries[i] is None:
+            j = next(resolved)
+            dirname, path = sources[j]
+            item = resolve(path, dirname, parsed=parsed[j])
+            parsed[j] = None
+            name = path.decode(config.PATH_ENCODING)
+            key = document_key(fingerprint, inputs, name, item.desc_path)
+            write_cache(key, tuple(item))
+            documents[name] = [key, item.desc_path, item.title, item.category, item.rank]
+            entries[i] = Entry(key, item.title, item.category, item.rank, path, item.desc_path)
+        entry = entries[i]
+        if entry.desc_path:
+            used_documents.add(entry.desc_path)
+        database[entry.category].append(entry)
+
+    enter_phase('concatenate')
     INFO('Concatenating documents...')
     cnt = 0
     toc = []
-    body = []
+    order = []  # [(category, [entry])]
     for category, docs in database.items():
         DEBUG('Processing category "%s"...' % category)
         toc.append(config.TOC_CATEGORY_TEMPLATE.format(category=category, category_md5=md5(category)))
-        for doc in sorted(docs, key=lambda doc: (doc.rank, doc.title)):
+        docs = sorted(docs, key=lambda doc: (doc.rank, doc.title))
+        for doc in docs:
             cnt += 1
             toc.append(config.TOC_TITLE_TEMPLATE.format(id=cnt, title=doc.title))
-            body.append(config.DOCUMENT_TEMPLATE.format(
-                id=cnt, title=doc.title, category=doc.category, category_md5=md5(doc.category),
-                path=doc.path.decode(config.PATH_ENCODING), description=doc.desc, code=doc.code))
+        order.append((category, docs))
 
     toc.append(config.TOC_CATEGORY_TEMPLATE.format(
         category=config.META_DOCUMENT_DEFAULT_CATEGORY,
         category_md5=md5(config.META_DOCUMENT_DEFAULT_CATEGORY)))
-    body.append(config.PAGE_SEPARATOR)
-
-    # Scan unused documents
-    for dirname, path, ext in file_list:
-        if ext not in config.DESCRIPTION_EXTENSIONS or path.decode(config.PATH_ENCODING) in used_documents:
-            continue
-        body.append(config.UNUSED_DOCUMENT_TEMPLATE.format(
-            title=path.decode(config.PATH_ENCODING), description=parse_markdown(path, dirname)))
 
-    if output_path is None:
-        output_path = os.path.abspath(config.OUTPUT_PATH)
+    def _documents(category, docs, cnt):
+        DEBUG('Writing category "%s"...' % category)
+        for doc in docs:
+            cnt += 1
+            item = load_document(doc)
+            yield config.DOCUMENT_TEMPLATE.format(
+                id=cnt, title=doc.title, category=doc.category, category_md5=md5(doc.category),
+                path=doc.path.decode(config.PATH_ENCODING), description=item.desc, code=item.code)
+
+    def _unused():
+        # Scan unused documents
+        for dirname, path, ext in file_list:
+            if ext not in config.DESCRIPTION_EXTENSIONS or path.decode(config.PATH_ENCODING) in used_documents:
+                continue
+            yield config.UNUSED_DOCUMENT_TEMPLATE.format(
+                title=path.decode(config.PATH_ENCODING), description=parse_markdown(path, dirname))
+
+    def _body():
+        cnt = 0
+        for category, docs in order:
+            for piece in _documents(category, docs, cnt):
+                yield piece
+            cnt += len(docs)
+        yield config.PAGE_SEPARATOR
+        for piece in _unused():
+            yield piece
+
+    enter_phase('write')
     output_folder = os.path.dirname(output_path)
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    fragments = []
+    body = _body()
+    if SPLIT_OUTPUT:
+        folder = fragment_folder(output_path)
+        DEBUG('Writing fragments into "%s"...' % folder)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        placeholders = []
+        cnt = 0
+        for category, docs in order:
+            fragments.append(write_fragment(folder, md5(category), _documents(category, docs, cnt)))
+            placeholders.append(fragment_placeholder(folder, fragments[-1], cnt + 1, cnt + len(docs)))
+            cnt += len(docs)
+        placeholders.append(config.PAGE_SEPARATOR)
+        fragments.append(write_fragment(folder, md5(config.META_DOCUMENT_DEFAULT_CATEGORY), _unused()))
+        placeholders.append(fragment_placeholder(folder, fragments[-1]))
+        # Fragments of the previous build are kept until the next one, for
+        # clients and proxies still holding the previous index page
+        previous = (manifest if not DISABLE_CACHE else load_manifest(manifest_file)).get('fragments', [])
+        remove_stale_fragments(folder, fragments + previous)
+        body = placeholders + [FRAGMENT_LOADER]
     DEBUG('Writing into "%s"...' % output_path)
-    with open(output_path, 'w') as writer:
-        data = config.WEBPAGE_TEMPLATE.format(
-            document_title=config.DOCUMENT_TITLE,
-            document=config.CONTENT_TEMPLATE.format(
-                toc='\n'.join(toc),
-                separator=config.PAGE_SEPARATOR,
-                document='\n'.join(body)
-        ))
-        writer.write(data.encode(config.ENCODING))
-
+    page_head, page_tail = split_template(config.WEBPAGE_TEMPLATE, document_title=config.DOCUMENT_TITLE)
+    content_head, content_tail = split_template(
+        config.CONTENT_TEMPLATE, toc='\n'.join(toc), separator=config.PAGE_SEPARATOR)
+    write_atomic(output_path, [
+        page_head, compact_style() if COMPACT_OUTPUT else '', content_head,
+        join_lines(body), content_tail, page_tail
+    ])
+    INFO('%s bytes written to "%s".' % (os.path.getsize(output_path), output_path))
+
+    enter_phase('assets')
     DEBUG('Copying assets into "%s"...' % (output_folder))
     for name in config.ASSETS:
         path = os.path.join(output_folder, name)
+        if source_tree is not None:
+            blobs = source_tree.find(name)
+            if len(blobs) == 0:
+                WARN('File or directory "%s" does not exist. Ignored.' % name)
+            for blob in blobs:
+                DEBUG('Copy file "%s"...' % blob)
+                target = os.path.join(output_folder, blob)
+                if not os.path.exists(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                with open(target, 'wb') as writer:
+                    writer.write(read_source(blob))
+            continue
         if os.path.exists(path) and os.path.samefile(name, path):
             DEBUG('"%s" skipped.' % name)
             continue
@@ -715,5 +2552,25 @@ def main():
         else:
             WARN('File or directory "%s" does not exist. Ignored.' % name)
 
+    enter_phase('manifest')
+    save_manifest(manifest_file, {
+        'fingerprint': fingerprint,
+        'head': head,
+        'files': [path.decode(config.PATH_ENCODING) for _, path, _ in file_list],
+        'output': stat_file(output_path),
+        'fragments': fragments,
+        'inputs': inputs,
+        'documents': documents
+    })
+
+    if not DISABLE_CACHE:
+        INFO('Cache: %s hits, %s misses in "%s".' % (cache_hits, cache_misses, config.CACHE_DIRECTORY))
+        removed, total = prune_cache(getattr(config, 'CACHE_SIZE_LIMIT', DEFAULT_CACHE_SIZE_LIMIT))
+        if removed:
+            DEBUG('%s cache entries evicted. %s bytes left.' % (removed, total))
+    report_timings(args.timings, timings_file, args.profile)
+
+IMPORT_FINISHED = time.time()
+
 if __name__ == "__main__":
     main()
@@ -4,16 +4,27 @@ DEBUG_MODE = False
 
 import os
 import sys
+import gzip
 import json
 import hmac
 import shutil
+import socket
 import hashlib
+import sqlite3
 import tempfile
+import threading
 import subprocess
 
+from math import inf
+from time import time
 from datetime import datetime
 from filelock import FileLock
-from flask import Flask, request, abort
+from flask import Flask, request, abort, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # only .gz files are generated
 
 import logging as log
 log.basicConfig(
@@ -25,18 +36,35 @@ application = Flask(__name__)
 
 ENCODING = 'utf-8'
 DOCMELD_EXECUTABLE = './docmeld.py'
+DOCMELD_SOCKET = 'nginx/docmeld.socket'  # build server started by "docmeld.py --serve"
 DATABASE_DIRECTORY = 'database'
 WEBPAGE_DIRECTORY = '/var/www/html/docmeld'
 WEBURL = 'https://riteme.site/docmeld/'
 ROUTE = 'docmeld-webhook'
 STATUS_FILE = 'status.txt'
+TIMINGS_FILE = 'timings.json'  # "docmeld.py --timings json" report of the last build
 INDEX_FILE = 'index.html'
 TEMPORARY_INDEX_FILE = './nginx/temporary_index.html'
-OUTPUT_FILE = 'output.html'
+OUTPUT_DIRECTORY = 'outputs'  # under DATABASE_DIRECTORY, docmeld writes here
+BUILDS_DIRECTORY = 'builds'  # published versions, under each branch folder
+LATEST_LINK = 'latest'
+BUILDS_KEPT = 5
+COMPRESSED_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.txt')
+REDIRECT_PAGE = f'<!DOCTYPE html><meta http-equiv="refresh" content="0; url={LATEST_LINK}/">\n'
 GIT_URL_START = 'git+'
+CACHE_DIRECTORY = os.path.abspath(os.path.join(DATABASE_DIRECTORY, 'cache'))  # shared by all repos and branches
+GIT_FETCH_OPTIONS = []  # e.g. ['--filter', 'blob:none'] or ['--depth', '1']
 COMPILE_TIME_LIMIT = 300  # 5min
+QUEUE_DATABASE = 'queue.sqlite3'  # under DATABASE_DIRECTORY
+QUEUE_WORKERS = 1  # build threads per uWSGI process; branches build in separate worktrees
+QUEUE_POLL_INTERVAL = 1  # 1s
+QUEUE_STATUS_LIMIT = 100
+BUILD_DURATION_BUCKETS = (5, 10, 30, 60, 120, 300, inf)  # seconds
+QUEUE_WAIT_BUCKETS = (1, 5, 30, 60, 300, 900, inf)  # seconds
+HISTORY_DAYS = 7  # default period of /history
 
-# HTTP error codes
+# HTTP status codes
+ACCEPTED = 202
 BAD_REQUEST = 400
 UNAUTHORIZED = 401
 FORBIDDEN = 403
@@ -57,6 +85,596 @@ def get_utc_offset():
     offset = datetime.now().hour - datetime.utcnow().hour
     return f'+{offset}' if offset >= 0 else str(offset)
 
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, _, fnames in os.walk(path) for name in fnames)
+
+def hash_directory(path):
+    """MD5 of the relative paths and contents of all files under `path`."""
+    checksum = hashlib.md5()
+    for dirpath, dnames, fnames in os.walk(path):
+        dnames.sort()
+        for name in sorted(fnames):
+            file_path = os.path.join(dirpath, name)
+            checksum.update(os.path.relpath(file_path, path).encode(ENCODING) + b'\0')
+            with open(file_path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 16), b''):
+                    checksum.update(chunk)
+            checksum.update(b'\0')
+    return checksum.hexdigest()
+
+def compress_directory(path):
+    """Write .gz (and .br if brotli is installed) next to text files, for
+    nginx's gzip_static and brotli_static."""
+    for dirpath, _, fnames in os.walk(path):
+        for name in fnames:
+            if not name.endswith(COMPRESSED_EXTENSIONS):
+                continue
+            file_path = os.path.join(dirpath, name)
+            with open(file_path, 'rb') as fp:
+                data = fp.read()
+            with open(file_path + '.gz', 'wb') as fp:
+                fp.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(file_path + '.br', 'wb') as fp:
+                    fp.write(brotli.compress(data))
+
+def replace_file(path, data):
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as fp:
+        fp.write(data)
+    os.replace(temporary, path)
+
+def publish(output, folder):
+    """Publish the docmeld output directory `output` as
+    `folder/builds/<hash>` and switch `folder/latest` to it.
+
+    Returns the version, or None if it is already the latest one.
+    """
+    version = hash_directory(output)[:12]
+    builds = os.path.join(folder, BUILDS_DIRECTORY)
+    target = os.path.join(builds, version)
+    latest = os.path.join(folder, LATEST_LINK)
+    relative_target = os.path.join(BUILDS_DIRECTORY, version)
+    if os.path.islink(latest) and os.readlink(latest) == relative_target and os.path.isdir(target):
+        return None
+
+    if not os.path.isdir(target):
+        os.makedirs(builds, exist_ok=True)
+        staging = os.path.join(builds, f'.{version}.{os.getpid()}')
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        shutil.copytree(output, staging)
+        compress_directory(staging)
+        os.rename(staging, target)
+    else:
+        os.utime(target)  # a former version, now the newest
+
+    # rename() replaces the link in one step
+    link = f'{latest}.{os.getpid()}.tmp'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(relative_target, link)
+    os.replace(link, latest)
+    replace_file(os.path.join(folder, INDEX_FILE), REDIRECT_PAGE)
+    collect_builds(builds, version)
+    return version
+
+def collect_builds(builds, current):
+    """Remove published versions but the BUILDS_KEPT newest ones."""
+    versions = []
+    for entry in os.scandir(builds):
+        if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'):
+            versions.append((entry.stat().st_mtime, entry.name))
+    versions.sort(reverse=True)
+    for _, name in versions[BUILDS_KEPT:]:
+        if name == current:
+            continue
+        log.info(f'Removing build {name} in {builds}...')
+        shutil.rmtree(os.path.join(builds, name), ignore_errors=True)
+
+def run_docmeld(args, status):
+    """Run docmeld with `args` and append its output to the file `status`.
+
+    Jobs are sent to the build server if it is listening on DOCMELD_SOCKET,
+    otherwise a fresh docmeld process is launched. Returns the exit code of
+    docmeld and raises `subprocess.TimeoutExpired` after COMPILE_TIME_LIMIT.
+    """
+    if os.path.exists(DOCMELD_SOCKET):
+        try:
+            return run_docmeld_server(args, status)
+        except (ConnectionError, FileNotFoundError) as e:
+            log.warning(f'Build server unavailable ({e}). Fall back to subprocess.')
+
+    with open(status, 'a') as fp:
+        proc = subprocess.Popen(
+            [DOCMELD_EXECUTABLE] + args, stdout=fp, stderr=subprocess.STDOUT)
+        try:
+            return proc.wait(timeout=COMPILE_TIME_LIMIT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise
+
+def run_docmeld_server(args, status):
+    job = {
+        'argv': args,
+        'cwd': os.getcwd(),
+        'log': os.path.abspath(status),
+        'timeout': COMPILE_TIME_LIMIT
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(COMPILE_TIME_LIMIT)
+        sock.connect(DOCMELD_SOCKET)
+        log.info(f'Build job sent to {DOCMELD_SOCKET}.')
+        sock.sendall(json.dumps(job).encode(ENCODING) + b'\n')
+        try:
+            with sock.makefile('rb') as fp:
+                response = fp.readline()
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(args, COMPILE_TIME_LIMIT)
+    if not response:
+        raise ConnectionResetError('build server closed the connection')
+    return json.loads(response.decode(ENCODING))['returncode']
+
+# Build queue
+# Jobs are kept in a SQLite database shared by all uWSGI processes, so that
+# the queue survives restarts. States: queued → running → success/fail, or
+# queued → superseded when a newer push arrives for the same branch.
+QUEUED = 'queued'
+RUNNING = 'running'
+SUPERSEDED = 'superseded'
+
+queue_event = threading.Event()
+queue_workers_pid = None
+queue_workers_token = None
+
+def process_token(pid):
+    """Identify process `pid` by boot, PID and start time, or return None if it does not exist.
+
+    A PID alone may be reused by another process after a restart."""
+    try:
+        with open(f'/proc/{pid}/stat') as reader:
+            # The command name in parentheses may contain spaces
+            start_time = reader.read().rsplit(')', 1)[1].split()[19]
+        with open('/proc/sys/kernel/random/boot_id') as reader:
+            boot_id = reader.read().strip()
+    except (OSError, IndexError):
+        return None
+    return f'{boot_id}:{pid}:{start_time}'
+
+def queue_connect():
+    db = sqlite3.connect(
+        os.path.join(DATABASE_DIRECTORY, QUEUE_DATABASE),
+        timeout=COMPILE_TIME_LIMIT, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            repo TEXT NOT NULL,
+            clone_url TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            head TEXT NOT NULL,
+            message TEXT,
+            state TEXT NOT NULL,
+            worker TEXT,
+            enqueued_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            result TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+        CREATE INDEX IF NOT EXISTS jobs_branch ON jobs (repo, branch, state);
+        CREATE TABLE IF NOT EXISTS builds (
+            job_id INTEGER PRIMARY KEY,
+            repo TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            head TEXT NOT NULL,
+            status TEXT NOT NULL,
+            finished_at REAL NOT NULL,
+            duration REAL NOT NULL,
+            queue_wait REAL NOT NULL,
+            timeout INTEGER NOT NULL,
+            published_bytes INTEGER NOT NULL,
+            cache_hits INTEGER NOT NULL,
+            cache_misses INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS builds_repo ON builds (repo, finished_at);
+        CREATE INDEX IF NOT EXISTS builds_repo_duration ON builds (repo, duration);
+    """)
+    return db
+
+def enqueue(repo, clone_url, branch, head, message):
+    db = queue_connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        cursor = db.execute(
+            'UPDATE jobs SET state = ?, finished_at = ? '
+            'WHERE repo = ? AND branch = ? AND state = ?',
+            (SUPERSEDED, time(), repo, branch, QUEUED))
+        if cursor.rowcount:
+            log.info(f'{cursor.rowcount} queued build(s) of {repo}/{branch} superseded.')
+        cursor = db.execute(
+            'INSERT INTO jobs (repo, clone_url, branch, head, message, state, enqueued_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (repo, clone_url, branch, head, message, QUEUED, time()))
+        db.execute('COMMIT')
+        job_id = cursor.lastrowid
+    finally:
+        db.close()
+    queue_event.set()
+    return job_id
+
+def claim_job():
+    """Take the next job whose branch is not being built, or return None."""
+    db = queue_connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        job = db.execute(
+            'SELECT * FROM jobs AS j WHERE state = ? AND NOT EXISTS ('
+            'SELECT 1 FROM jobs WHERE repo = j.repo AND branch = j.branch AND state = ?) '
+            'ORDER BY id LIMIT 1', (QUEUED, RUNNING)).fetchone()
+        if job is not None:
+            # Only the newest head of a branch is worth building.
+            job = db.execute(
+                'SELECT * FROM jobs WHERE repo = ? AND branch = ? AND state = ? '
+                'ORDER BY id DESC LIMIT 1', (job['repo'], job['branch'], QUEUED)).fetchone()
+            db.execute(
+                'UPDATE jobs SET state = ?, finished_at = ? '
+                'WHERE repo = ? AND branch = ? AND state = ? AND id < ?',
+                (SUPERSEDED, time(), job['repo'], job['branch'], QUEUED, job['id']))
+            db.execute(
+                'UPDATE jobs SET state = ?, worker = ?, started_at = ? WHERE id = ?',
+                (RUNNING, queue_workers_token, time(), job['id']))
+        db.execute('COMMIT')
+    finally:
+        db.close()
+    return job
+
+def finish_job(job_id, result):
+    db = queue_connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute(
+            'UPDATE jobs SET state = ?, finished_at = ?, result = ? WHERE id = ?',
+            (result['status'], time(), json.dumps(result), job_id))
+        record_build(db, db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
+def recover_jobs():
+    """Requeue jobs left running by processes that no longer exist."""
+    db = queue_connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for job in db.execute('SELECT id, worker FROM jobs WHERE state = ?', (RUNNING,)).fetchall():
+            # Older queues stored bare PIDs
+            token = job['worker'] if isinstance(job['worker'], str) else ''
+            parts = token.split(':')
+            if len(parts) != 3 or process_token(parts[1]) != token:
+                log.warning(f'Job #{job["id"]} was interrupted. Requeued.')
+                db.execute(
+                    'UPDATE jobs SET state = ?, worker = NULL, started_at = NULL WHERE id = ?',
+                    (QUEUED, job['id']))
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
+def queue_status(repo=None, branch=None):
+    db = queue_connect()
+    try:
+        rows = db.execute(
+            'SELECT * FROM jobs WHERE (? IS NULL OR repo = ?) AND (? IS NULL OR branch = ?) '
+            'ORDER BY id DESC LIMIT ?',
+            (repo, repo, branch, branch, QUEUE_STATUS_LIMIT)).fetchall()
+        queued = [row['id'] for row in db.execute(
+            'SELECT id FROM jobs WHERE state = ? ORDER BY id', (QUEUED,))]
+    finally:
+        db.close()
+
+    def _format_time(t):
+        return None if t is None else datetime.fromtimestamp(t).isoformat()
+
+    position = {job_id: i + 1 for i, job_id in enumerate(queued)}
+    return [{
+        'id': row['id'],
+        'repo': row['repo'],
+        'branch': row['branch'],
+        'head': row['head'],
+        'state': row['state'],
+        'position': position.get(row['id']),
+        'enqueued_at': _format_time(row['enqueued_at']),
+        'started_at': _format_time(row['started_at']),
+        'finished_at': _format_time(row['finished_at']),
+        'result': json.loads(row['result']) if row['result'] else None
+    } for row in rows]
+
+# Build history
+# Every finished job is also stored as a row of the "builds" table, with the
+# figures /metrics and /history aggregate. Being in the queue database, they
+# are shared by all uWSGI processes and computed with SQL on request.
+def record_build(db, job):
+    result = json.loads(job['result']) if job['result'] else {}
+    cache = result.get('cache') or {}
+    db.execute(
+        'INSERT OR IGNORE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (job['id'], job['repo'], job['branch'], job['head'], job['state'], job['finished_at'],
+         job['finished_at'] - job['started_at'], job['started_at'] - job['enqueued_at'],
+         int(result.get('timeout', False)), result.get('published_bytes', 0),
+         cache.get('hits', 0), cache.get('misses', 0)))
+
+def migrate_history():
+    """Add jobs finished before the builds table existed."""
+    db = queue_connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for job in db.execute(
+                'SELECT * FROM jobs WHERE state NOT IN (?, ?, ?) AND started_at IS NOT NULL '
+                'AND id NOT IN (SELECT job_id FROM builds)', (QUEUED, RUNNING, SUPERSEDED)).fetchall():
+            record_build(db, job)
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
+def build_history(repo, since):
+    """Count and percentiles of the build time of `repo` since `since`."""
+    db = queue_connect()
+    try:
+        count, mean = db.execute(
+            'SELECT COUNT(*), AVG(duration) FROM builds WHERE repo = ? AND finished_at >= ?',
+            (repo, since)).fetchone()
+
+        def _percentile(q):
+            if count == 0:
+                return None
+            row = db.execute(
+                'SELECT duration FROM builds WHERE repo = ? AND finished_at >= ? '
+                'ORDER BY duration LIMIT 1 OFFSET ?', (repo, since, int(q * (count - 1)))).fetchone()
+            return row['duration']
+
+        statuses = dict(db.execute(
+            'SELECT status, COUNT(*) FROM builds WHERE repo = ? AND finished_at >= ? GROUP BY status',
+            (repo, since)).fetchall())
+        return {
+            'repo': repo,
+            'since': datetime.fromtimestamp(since).isoformat(),
+            'builds': count,
+            'statuses': statuses,
+            'mean': mean,
+            'p50': _percentile(0.5),
+            'p95': _percentile(0.95),
+            'max': _percentile(1)
+        }
+    finally:
+        db.close()
+
+def format_labels(**labels):
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+def format_histogram(lines, name, column, buckets, db):
+    counters = ', '.join(f'SUM({column} <= ?)' for _ in buckets)
+    bounds = [b if b != inf else 1e308 for b in buckets]
+    for row in db.execute(
+            f'SELECT repo, COUNT(*), SUM({column}), {counters} FROM builds GROUP BY repo', bounds):
+        repo, count, total = row[0], row[1], row[2]
+        for bucket, value in zip(buckets, row[3:]):
+            le = '+Inf' if bucket == inf else bucket
+            lines.append(f'{name}_bucket{format_labels(repo=repo, le=le)} {value}')
+        lines.append(f'{name}_sum{format_labels(repo=repo)} {total}')
+        lines.append(f'{name}_count{format_labels(repo=repo)} {count}')
+
+def format_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+
+    def _metric(name, kind, description, rows):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in rows:
+            lines.append(f'{name}{format_labels(**labels)} {value}')
+
+    db = queue_connect()
+    try:
+        _metric('docmeld_builds_total', 'counter', 'Finished builds by outcome.', [
+            ({'repo': repo, 'status': status}, count) for repo, status, count in db.execute(
+                'SELECT repo, status, COUNT(*) FROM builds GROUP BY repo, status')])
+        _metric('docmeld_build_timeouts_total', 'counter', 'Builds killed after COMPILE_TIME_LIMIT.', [
+            ({'repo': repo}, count) for repo, count in db.execute(
+                'SELECT repo, SUM(timeout) FROM builds GROUP BY repo')])
+        _metric('docmeld_superseded_jobs_total', 'counter', 'Queued jobs replaced by a newer push.', [
+            ({'repo': repo}, count) for repo, count in db.execute(
+                'SELECT repo, COUNT(*) FROM jobs WHERE state = ? GROUP BY repo', (SUPERSEDED,))])
+        _metric('docmeld_published_bytes_total', 'counter', 'Bytes of published versions, compressed files included.', [
+            ({'repo': repo}, count) for repo, count in db.execute(
+                'SELECT repo, SUM(published_bytes) FROM builds GROUP BY repo')])
+        cache = db.execute(
+            'SELECT repo, SUM(cache_hits), SUM(cache_misses) FROM builds GROUP BY repo').fetchall()
+        _metric('docmeld_cache_hits_total', 'counter', 'Cache hits of docmeld.', [
+            ({'repo': repo}, hits) for repo, hits, _ in cache])
+        _metric('docmeld_cache_misses_total', 'counter', 'Cache misses of docmeld.', [
+            ({'repo': repo}, misses) for repo, _, misses in cache])
+        _metric('docmeld_cache_hit_ratio', 'gauge', 'Cache hits over cache lookups of all builds.', [
+            ({'repo': repo}, hits / (hits + misses)) for repo, hits, misses in cache if hits + misses])
+        _metric('docmeld_queue_jobs', 'gauge', 'Jobs waiting or being built.', [
+            ({'state': state}, count) for state, count in db.execute(
+                'SELECT state, COUNT(*) FROM jobs WHERE state IN (?, ?) GROUP BY state', (QUEUED, RUNNING))])
+        for name, column, buckets, description in [
+                ('docmeld_build_duration_seconds', 'duration', BUILD_DURATION_BUCKETS, 'Time from the start to the end of builds.'),
+                ('docmeld_queue_wait_seconds', 'queue_wait', QUEUE_WAIT_BUCKETS, 'Time builds waited in the queue.')]:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} histogram')
+            format_histogram(lines, name, column, buckets, db)
+    finally:
+        db.close()
+    return '\n'.join(lines) + '\n'
+
+def queue_worker():
+    while True:
+        job = claim_job()
+        if job is None:
+            queue_event.wait(QUEUE_POLL_INTERVAL)
+            queue_event.clear()
+            continue
+        log.info(f'Job #{job["id"]} started: {job["repo"]}/{job["branch"]} at {job["head"]}.')
+        try:
+            result = build(job)
+        except Exception as e:
+            log.exception(f'Job #{job["id"]} crashed.')
+            result = {
+                'status': 'fail',
+                'reason': f'internal error: {e}'
+            }
+        finish_job(job['id'], result)
+        log.info(f'Job #{job["id"]} finished: {result["status"]}.')
+
+def start_queue_workers():
+    """Start the build threads of this process. Safe to call repeatedly."""
+    global queue_workers_pid
+    global queue_workers_token
+
+    if queue_workers_pid == os.getpid():
+        return
+    queue_workers_pid = os.getpid()
+    queue_workers_token = process_token(queue_workers_pid)
+    recover_jobs()
+    migrate_history()
+    for _ in range(QUEUE_WORKERS):
+        threading.Thread(target=queue_worker, daemon=True).start()
+    log.info(f'{QUEUE_WORKERS} build worker(s) started in process {os.getpid()}.')
+
+def build(job):
+    repo = job['repo']
+    clone_url = job['clone_url']
+    branch = job['branch']
+    head = job['head']
+    record_file_path = f'{DATABASE_DIRECTORY}/{md5(clone_url)}.json'
+    with open(record_file_path, 'r') as fp:
+        record = json.load(fp)
+
+    folder_name = '%s/%s' % (repo, branch)
+    folder = os.path.join(WEBPAGE_DIRECTORY, folder_name)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    status = os.path.join(folder, STATUS_FILE)
+    timings = os.path.abspath(os.path.join(folder, TIMINGS_FILE))
+    index = os.path.join(folder, INDEX_FILE)
+    # A fixed path, so that docmeld finds the manifest of the last build
+    output = os.path.abspath(os.path.join(
+        DATABASE_DIRECTORY, OUTPUT_DIRECTORY, md5(f'{clone_url}#{branch}'), INDEX_FILE))
+    status_url = WEBURL + os.path.join(folder_name, STATUS_FILE)
+    index_url = WEBURL + os.path.join(folder_name, LATEST_LINK, INDEX_FILE)
+
+    index_lock = index + '.lock'
+    with FileLock(index_lock):
+        if not os.path.lexists(os.path.join(folder, LATEST_LINK)):
+            log.info(f'Copying {TEMPORARY_INDEX_FILE} to {index}')
+            shutil.copyfile(TEMPORARY_INDEX_FILE, index)
+
+        tmpfd, tmppath = tempfile.mkstemp()
+        log.debug('tmppath = %s', tmppath)
+        with os.fdopen(tmpfd, 'w') as fp:
+            json.dump(record['checksums'], fp)
+
+        log.info('Launching docmeld...')
+        with open(status, 'w') as fp:
+            fp.write(f'Current server time: {str(datetime.now())} (UTC{get_utc_offset()})\n')
+            fp.write(f'Build for commit #{head}: {job["message"]}\n')
+        args = [GIT_URL_START + clone_url,
+                '-b', branch, '-s', head, '-c', tmppath, '-o', output,
+                '--cache-dir', CACHE_DIRECTORY,
+                '--timings', 'json', '--timings-file', timings,
+                '-v' if DEBUG_MODE else '-q'] + GIT_FETCH_OPTIONS
+        # Only rescan files changed since the last build of this branch
+        last_build = record.get('last_builds', {}).get(branch)
+        if last_build is not None:
+            args += ['--since', last_build]
+        try:
+            returncode = run_docmeld(args, status)
+        except subprocess.TimeoutExpired as e:
+            log.error('Time limit exceeded.')
+            return {
+                'status': 'fail',
+                'reason': f'time limit exceeded ({e.timeout}s)',
+                'timeout': True,
+                'detail': status_url
+            }
+        finally:
+            os.remove(tmppath)
+
+        if returncode != 0:
+            log.error(f'docmeld execution failed with status code {returncode}', )
+            return {
+                'status': 'fail',
+                'reason': f'docmeld failed with status code {returncode}',
+                'returncode': returncode,
+                'detail': status_url
+            }
+
+        version = publish(os.path.dirname(output), folder)
+        published_bytes = 0
+        if version is None:
+            log.info('Output unchanged. Nothing published.')
+        else:
+            published_bytes = directory_size(os.path.join(folder, BUILDS_DIRECTORY, version))
+            log.info(f'Build {version} ({published_bytes} bytes) published to {folder}.')
+
+    # Other branches may be built at the same time. The record is replaced
+    # as a whole, so readers never see a partial file.
+    with FileLock(record_file_path + '.lock'):
+        with open(record_file_path, 'r') as fp:
+            record = json.load(fp)
+        record['last_build'] = head
+        record.setdefault('last_builds', {})[branch] = head
+        replace_file(record_file_path, json.dumps(record, sort_keys=True, indent=4))
+
+    # Kept with the job, so that builds can be compared over time
+    try:
+        with open(timings, 'r') as fp:
+            report = json.load(fp)
+        summary = {phase['name']: round(phase['wall'], 3) for phase in report['phases']}
+        summary['total'] = round(report['total']['wall'], 3)
+        summary['peak_rss'] = report['peak_rss']['self']
+        cache = report['cache']
+    except (OSError, ValueError, KeyError):
+        summary = cache = None
+
+    return {
+        'status': 'success',
+        'returncode': returncode,
+        'published': version,
+        'published_bytes': published_bytes,
+        'timings': summary,
+        'cache': cache,
+        'output_url': index_url,
+        'detail': status_url
+    }
+
+@application.before_request
+def ensure_queue_workers():
+    start_queue_workers()
+
+@application.route(f'/{ROUTE}/status', methods=['GET'])
+def show_status():
+    return json.dumps({
+        'jobs': queue_status(request.args.get('repo'), request.args.get('branch'))
+    }), {'Content-Type': 'application/json'}
+
+@application.route(f'/{ROUTE}/history', methods=['GET'])
+def show_history():
+    repo = request.args.get('repo')
+    if repo is None:
+        abort(BAD_REQUEST)
+    days = request.args.get('days', HISTORY_DAYS, type=float)
+    return json.dumps(build_history(repo, time() - days * 86400)), {'Content-Type': 'application/json'}
+
+@application.route(f'/{ROUTE}/metrics', methods=['GET'])
+def show_metrics():
+    return format_metrics(), {'Content-Type': 'text/plain; version=0.0.4'}
+
 @application.route(f'/{ROUTE}/', methods=['GET', 'POST'])
 def main():
     if request.method != 'POST':
@@ -116,71 +734,14 @@ def main():
 
     branch = payload['ref'].rsplit('/', 1)[-1]
     commit = payload['head_commit']
-    head = commit['id']
-    folder_name = '%s/%s' % (repo, branch)
-    folder = os.path.join(WEBPAGE_DIRECTORY, folder_name)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    status = os.path.join(folder, STATUS_FILE)
-    index = os.path.join(folder, INDEX_FILE)
-    output = os.path.join(folder, OUTPUT_FILE)
-    status_url = WEBURL + os.path.join(folder_name, STATUS_FILE)
-    index_url = WEBURL + os.path.join(folder_name, INDEX_FILE)
-
-    index_lock = index + '.lock'
-    with FileLock(index_lock):
-        log.info(f'Copying {TEMPORARY_INDEX_FILE} to {index}')
-        shutil.copyfile(TEMPORARY_INDEX_FILE, index)
-
-        tmpfd, tmppath = tempfile.mkstemp()
-        log.debug('tmppath = %s', tmppath)
-        with os.fdopen(tmpfd, 'w') as fp:
-            json.dump(record['checksums'], fp)
-
-        log.info('Launching docmeld...')
-        with open(status, 'w') as fp:
-            fp.write(f'Current server time: {str(datetime.now())} (UTC{get_utc_offset()})\n')
-            fp.write(f'Build for commit #{head}: {commit["message"]}\n')
-        with open(status, 'a') as fp:
-            proc = subprocess.Popen(
-                [DOCMELD_EXECUTABLE, GIT_URL_START + clone_url,
-                 '-b', branch, '-s', head, '-c', tmppath, '-o', output,
-                 '-v' if DEBUG_MODE else '-q'],
-                stdout=fp, stderr=subprocess.STDOUT)
-
-            try:
-                proc.wait(timeout=COMPILE_TIME_LIMIT)
-            except subprocess.TimeoutExpried as e:
-                log.error('Time limit exceeded.')
-                return json.dumps({
-                    'status': 'fail',
-                    'reason': f'time limit exceeded ({e.timeout}s)',
-                    'detail': status_url
-                })
-
-        if proc.returncode != 0:
-            log.error(f'docmeld execution failed with status code {proc.returncode}', )
-            return json.dumps({
-                'status': 'fail',
-                'reason': f'docmeld failed with status code {proc.returncode}',
-                'returncode': proc.returncode,
-                'detail': status_url
-            })
-
-        log.info(f'Copying {output} to {index}...')
-        shutil.copyfile(output, index)
-
-    os.remove(tmppath)
-    record['last_build'] = head
-    with open(record_file_path, 'w') as fp:
-        json.dump(record, fp, sort_keys=True, indent=4)
+    job_id = enqueue(repo, clone_url, branch, commit['id'], commit['message'])
+    log.info(f'Job #{job_id} queued: {repo}/{branch} at {commit["id"]}.')
 
     return json.dumps({
-        'status': 'success',
-        'returncode': proc.returncode,
-        'output_url': index_url,
-        'detail': status_url
-    })
+        'status': 'queued',
+        'job': job_id,
+        'detail': url_for('show_status', repo=repo, branch=branch, _external=True)
+    }), ACCEPTED
 
 if __name__ == '__main__':
     application.run(host='0.0.0.0', debug=DEBUG_MODE)
\ No newline at end of file
@@ -1,4 +1,7 @@
-from docmeld_webhook import application
+from docmeld_webhook import application, start_queue_workers
+
+# uWSGI loads this module in every worker process ("lazy-apps")
+start_queue_workers()
 
 if __name__ == '__main__':
     application.run()
\ No newline at end of file